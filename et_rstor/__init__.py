@@ -6,63 +6,196 @@ Package et_rstor
 A package for generating .rst documents with Python commands.
 
 """
+# Modules that are only needed by some features (subprocess, shutil, io, traceback, hashlib,
+# sqlite3, logging) are imported where they are used, to keep ``import et_rstor`` fast.
 
 from pathlib import Path
-import subprocess
-import shutil
 import re
-from contextlib import redirect_stdout, redirect_stderr, contextmanager
-import io
+from contextlib import contextmanager, nullcontext
 import sys
 import os
-import traceback
+import contextvars
+import threading
+import time
 
 __version__ = "1.2.0"
 
+_default_document = contextvars.ContextVar('default_document', default=None)
+"""The RstDocument that RstItems are added to if no document is specified.
+
+A context variable, rather than a global, so that documents can be built concurrently in
+different threads or asyncio tasks.
+"""
+
 ####################################################################################################
 # RstDocument
 ####################################################################################################
 class RstDocument:
 
+    observers = []
+    """Callables that are called with every RstDocument that is created."""
+
     def __init__( self, name
                 , headings_numbered_from_level=None
                 , is_default_document=False
                 , verbose=True
                 , width=72
+                , stream_to=None
+                , lazy=False
+                , cache=None
+                , split_level=None
+                , drop_sources=False
+                , progress=None
+                , profiler=None
                 ):
         """Create a RstDocument.
 
         :param str name: name of the document, used as a filename for writing the document.
         :param int width: used by TextWrapper to convert long strings into lines.
+        :param (bool,int) verbose: which progress messages are logged while building the document
+            (see :py:func:`progress_logger`): False for none, True for one line per RstItem
+            (:py:data:`ITEM`), or a level: :py:data:`SUMMARY` for one line per document written,
+            :py:data:`RST` for the full ``.rst`` of every RstItem and every line executed.
         :param in_range(6) headings_numbered_from_level: heading level from which numbering will be used.
         :param bool is_default_document: if True any RstItem created without specifying a document will
-            automatically be added to this RstDocument.
+            automatically be added to this RstDocument, in the current thread or asyncio task (see
+            also :py:meth:`as_default`).
+        :param (Path,str) stream_to: if not None, the document is streamed to the file
+            ``<stream_to>/<name>.rst``. A temporary file is opened here, and every RstItem is written
+            to it as soon as it is rendered, and then dropped, so memory use does not grow with the
+            size of the document. The file is closed by :py:meth:`write` or :py:meth:`close`.
+        :param bool lazy: if True, RstItems only record their parameters when they are created. They
+            are rendered, and CodeBlocks executed, by :py:meth:`render` or :py:meth:`write`. Until then,
+            :py:attr:`items` can be inspected, filtered or reordered at no cost. Headings are numbered
+            in the order of the items when the document is rendered.
+        :param RenderCache cache: if not None, RstItems that are cacheable are fetched from this
+            cache, instead of being rendered, when their fingerprint is found.
+        :param int split_level: if not None, :py:meth:`write` splits the document into separate
+            files at every Heading of this level, and writes a parent document with a ``toctree``
+            referring to them. See :py:meth:`split` Not possible for a streamed document.
+        :param bool drop_sources: if True, the :py:attr:`RstItem.source_fields` of every RstItem are
+            set to None as soon as it is rendered, to save memory. The items can then no longer be
+            rendered again.
+        :param ProgressBar progress: if not None, a live progress line is shown while the document
+            is built, with an estimate of the remaining time based on the previous build.
+        :param Profiler profiler: if not None, the time spent in the phases of building the
+            document is recorded per RstItem. See :py:meth:`profile_report`.
         """
         self.items = []
+        self.unfinished = {} # id -> (RstItem, number of items when it was created)
         self.name = name
 
         self.heading_numbers = 6*[-1]
         self.headings_numbered_from_level = 6 # = no numbering of headings
+        self.initial_heading_numbers = None # the heading_numbers when the first Heading was created
 
         self.width = width
         self.set_textwrapper()
 
-        if headings_numbered_from_level < 6:
+        if headings_numbered_from_level is not None and headings_numbered_from_level < 6:
             self.headings_numbered_from_level = headings_numbered_from_level
             for l in range(headings_numbered_from_level,6):
                 self.heading_numbers[l] = 0
 
         if is_default_document:
-            RstItem.default_document = self
+            _default_document.set(self)
 
         self.verbose = verbose
+        self.created = time.perf_counter()
 
         self.rst = ''
 
+        self.lazy = lazy
+        self.cache = cache
+        self.split_level = split_level
+        self.drop_sources = drop_sources
+        self.progress = progress
+        self.profiler = profiler
+        self.hooks = Hooks()
+        self.inputs = {} # Path -> is directory tree
+        self.directory = None # where the document is written
+        self.stream = None
+        if stream_to is not None:
+            if lazy:
+                raise ValueError('A lazy RstDocument cannot be streamed.')
+            if split_level is not None:
+                raise ValueError('A streamed RstDocument cannot be split.')
+            self.stream_path = Path(stream_to) / f'{self.name}.rst'
+            self.directory = self.stream_path.parent.resolve()
+            self.stream = open_temporary(self.stream_path)
+            import hashlib
+            self.stream_hash = hashlib.sha256()
+
+        for observer in RstDocument.observers:
+            observer(self)
+
 
     def append(self, item):
-        """Append an Rstitem item to this RstDocument."""
-        self.items.append(item)
+        """Append an Rstitem item to this RstDocument.
+
+        If the document is streamed, the item is written to the output file instead of being stored.
+        """
+        if self.stream:
+            data = item.rst.encode('utf-8')
+            self.stream.write(data)
+            self.stream_hash.update(data)
+        else:
+            self.items.append(item)
+
+
+    @contextmanager
+    def as_default(self):
+        """Context manager making this RstDocument the default document while the body executes.
+
+        Any RstItem created without specifying a document in the body is added to this RstDocument.
+        The previous default document is restored afterwards.
+        """
+        token = _default_document.set(self)
+        try:
+            yield self
+        finally:
+            _default_document.reset(token)
+
+
+    def add_input(self, path, tree=False, relative_to_document=False):
+        """Record a file, or directory tree, that is read while building the document.
+
+        :param (Path,str) path: the file or directory.
+        :param bool tree: if True, path is a directory, and all files in it are inputs.
+        :param bool relative_to_document: if True, a relative path is relative to the directory
+            the document is written to (as for ``.. include::`` and ``.. image::``), otherwise it
+            is relative to the current working directory.
+        """
+        path = Path(path)
+        if not relative_to_document:
+            path = path.resolve()
+        self.inputs[path] = self.inputs.get(path, False) or tree
+
+
+    def input_paths(self):
+        """The inputs recorded by :py:meth:`add_input` as absolute paths.
+
+        :return: dict mapping each input to True if it is a directory tree, False otherwise.
+        """
+        directory = self.directory or Path.cwd()
+        return {(directory / path).resolve(): tree for path, tree in self.inputs.items()}
+
+
+    def progress_level(self):
+        """The lowest level of the progress messages logged for this document, None if no progress
+        messages are logged.
+        """
+        if self.verbose is True:
+            return ITEM
+        return self.verbose or None
+
+
+    def log(self, level, message):
+        """Log a progress message, if level is not below :py:meth:`progress_level`."""
+        threshold = self.progress_level()
+        if threshold is not None and level >= threshold:
+            progress_logger().log(level, message)
+
 
     def set_textwrapper(self, textwrapper=None):
         """Set a TextWrapper object for the RstDocument"""
@@ -74,11 +207,71 @@ class RstDocument:
             raise ValueError('Argument must be a TextWrapper object.')
 
 
+    def adopt_unfinished(self):
+        """Add the RstItems that were created for this document, but never finished.
+
+        Derived RstItem classes written for et_rstor 1.2.0 call ``self.rstor()`` at the end of the
+        ctor, instead of ``self.finish()``. Such items are inserted in :py:attr:`items` where they
+        were created, with a FutureWarning. Unfinished items that were never rendered (because
+        their ctor raised an exception) are discarded.
+        """
+        if not self.unfinished:
+            return
+        unfinished = [(position, item) for item, position in self.unfinished.values() if item.rst is not None]
+        self.unfinished.clear()
+        if not unfinished:
+            return
+        import warnings
+        names = ', '.join(sorted({item.__class__.__name__ for _, item in unfinished}))
+        warnings.warn( f'RstItems of class {names} were created, but not finished. Call self.finish() '
+                       f'at the end of the ctor, instead of self.rstor().'
+                     , FutureWarning, stacklevel=3
+                     )
+        if self.stream:
+            raise RuntimeError(f'Unfinished RstItems of class {names} cannot be added to a streamed document.')
+        for i, (position, item) in enumerate(sorted(unfinished, key=lambda x: x[0])):
+            self.items.insert(position + i, item)
+
+
+    def number_headings(self):
+        """Number the Headings in the order of :py:attr:`items`.
+
+        Lazy documents do so when they are rendered, so that filtering or reordering the items
+        leaves no gaps in the numbering. The numbering starts from the :py:attr:`heading_numbers`
+        the first Heading was created with, so that presets like ``doc.heading_numbers[2] = 3`` are
+        respected. Headings that were already rendered with another number are rendered again
+        (unless their sources were dropped).
+        """
+        if self.initial_heading_numbers is None:
+            self.initial_heading_numbers = list(self.heading_numbers)
+        self.heading_numbers = list(self.initial_heading_numbers)
+        for item in self.items:
+            if isinstance(item, Heading):
+                heading = item.number()
+                if item.rst is None:
+                    item.heading = heading
+                elif heading != item.heading and not self.drop_sources:
+                    item.heading = heading
+                    item.rst = None
+
+
+    def render(self):
+        """Render all RstItems that have not been rendered yet, and concatenate them.
+
+        The Headings of a lazy document are numbered first, see :py:meth:`number_headings`.
+        """
+        self.adopt_unfinished()
+        if self.lazy:
+            self.number_headings()
+        for item in self.items:
+            if item.rst is None:
+                item.render()
+        self.rstor()
+
+
     def rstor(self):
         """Concatenate all RstItems"""
-        self.rst = ''
-        for item in self.items:
-            self.rst += item.rst
+        self.rst = ''.join(item.rst for item in self.items)
 
 
     # def __str__(self):
@@ -88,15 +281,202 @@ class RstDocument:
 
 
     def write(self, path='.'):
-        """Write the document to a file.
+        """Write the document to a file, unless its content did not change.
+
+        The file is written atomically, so that a crash never leaves a half-written file behind.
+        If the document is streamed, all items have already been written, and the file is just closed.
 
-        :param (Path,str) path: directory to create the file in.
+        :param (Path,str) path: directory to create the file in (ignored if the document is streamed).
+        :return: True if the file was changed, False otherwise.
         """
-        if not self.rst:
-            self.rstor()
-        p = path / f'{self.name}.rst'
-        with p.open(mode='w') as f:
-            f.write(self.rst)
+        if self.stream:
+            self.adopt_unfinished()
+            self.call_hooks('before_write', self)
+            with self.timed('write'):
+                changed = self.close()
+        else:
+            self.render()
+            self.directory = Path(path).resolve()
+            self.call_hooks('before_write', self)
+            with self.timed('write'):
+                if self.split_level is None:
+                    changed = write_if_changed(self.directory / f'{self.name}.rst', self.rst)
+                else:
+                    changed = self.write_chunks()
+        if self.cache is not None:
+            self.cache.commit()
+        if self.progress is not None:
+            self.progress.finish(self)
+        if self.profiler is not None:
+            self.profiler.record(self, 'build', time.perf_counter() - self.created, start=self.created)
+        self.log( SUMMARY
+                , f"rstor> {self.directory / self.name}.rst {'written' if changed else 'unchanged'}"
+                  f" ({time.perf_counter() - self.created:.2f} s)"
+                )
+        return changed
+
+
+    def hooked(self):
+        """Whether any hooks are registered for this document, or globally."""
+        return bool(hooks or self.hooks)
+
+
+    def call_hooks(self, event, *args):
+        """Call the global hooks, and then the hooks of this document, registered for event.
+
+        :return: the first result of a hook that is not None, or None.
+        """
+        result = None
+        for hook in getattr(hooks, event) + getattr(self.hooks, event):
+            r = hook(*args)
+            if result is None:
+                result = r
+        return result
+
+
+    def timed(self, phase, **args):
+        """Context manager recording the time the body takes as phase of this document, if it has
+        a profiler.
+        """
+        if self.profiler is None:
+            return _untimed
+        return self.profiler.timed(self, phase, **args)
+
+
+    def profile_report(self, n=20, format='text'):
+        """Report of the slowest RstItems of this document, see :py:meth:`Profiler.report`."""
+        return self.profiler.report(n=n, document=self.name, format=format)
+
+
+    def write_chunks(self):
+        """Write the parts of the document made by :py:meth:`split`, each unless it did not change.
+
+        :return: True if any file was changed, False otherwise.
+        """
+        chunks = self.split(self.split_level)
+        changed = False
+        for name, rst in chunks:
+            changed |= write_if_changed(self.directory / f'{name}.rst', rst)
+        # remove chunks left over from a previous, longer, version of the document
+        for p in self.directory.glob(f'{self.name}-[0-9][0-9][0-9].rst'):
+            if int(p.stem[-3:]) >= len(chunks):
+                p.unlink()
+                changed = True
+        return changed
+
+
+    def split(self, level):
+        """Split the document at every Heading of level.
+
+        Each part starting with such a Heading becomes a separate document, named
+        ``<name>-001``, ``<name>-002``, ... The parent document, named ``<name>``, consists of the
+        items before the first such Heading, followed by a ``toctree`` directive listing the parts.
+        After the first part, Headings of a lower level also start a new part.
+        The Include items of the parent document are repeated at the top of every part, so that
+        e.g. hyperlink targets remain defined. Crosslinks remain valid because labels are global
+        in Sphinx.
+
+        The document must be rendered.
+
+        :param int level: heading level at which to split.
+        :return: list of (name, rst) tuples, the parent document first.
+        """
+        parent = []
+        parts = []
+        for item in self.items:
+            if isinstance(item, Heading) and (item.level == level or (parts and item.level < level)):
+                parts.append([item])
+            elif parts:
+                parts[-1].append(item)
+            else:
+                parent.append(item)
+
+        if len(parts) > 999:
+            raise ValueError(f'Too many parts ({len(parts)}), split at a lower level.')
+        includes = ''.join(item.rst for item in parent if isinstance(item, Include))
+        names = [f'{self.name}-{i+1:03d}' for i in range(len(parts))]
+        toctree = '.. toctree::\n\n' + ''.join(f'   {name}\n' for name in names) + '\n'
+        chunks = [(self.name, ''.join(item.rst for item in parent) + toctree)]
+        for name, part in zip(names, parts):
+            chunks.append((name, includes + ''.join(item.rst for item in part)))
+        return chunks
+
+
+    def close(self):
+        """Close the output file of a streamed document.
+
+        The streamed output replaces ``<stream_to>/<name>.rst`` only if its content changed.
+
+        :return: True if the file was changed, False otherwise.
+        """
+        if not self.stream:
+            return False
+        self.stream.close()
+        tmp = self.stream.name
+        self.stream = None
+        if file_digest(self.stream_path) == self.stream_hash.hexdigest():
+            os.remove(tmp)
+            return False
+        os.replace(tmp, self.stream_path)
+        return True
+
+
+    def save(self, path):
+        """Save the document model, i.e. its parameters and RstItems, to a JSON file.
+
+        The captured output of executed CodeBlocks is saved too, so that the loaded document can be
+        rendered again (e.g. with another width) without executing anything. If path ends with
+        ``.gz``, the file is gzip compressed.
+
+        :param (Path,str) path: the file to save to.
+        """
+        if self.stream:
+            raise ValueError('A streamed RstDocument has no items to save.')
+        if self.drop_sources:
+            raise ValueError('An RstDocument with drop_sources=True cannot be saved.')
+        import json
+        model = { 'et_rstor': __version__
+                , 'name': self.name
+                , 'width': self.width
+                , 'headings_numbered_from_level': self.headings_numbered_from_level
+                , 'heading_numbers': self.heading_numbers
+                , 'initial_heading_numbers': self.initial_heading_numbers
+                , 'items': [item.state() for item in self.items]
+                }
+        data = json.dumps(model, separators=(',', ':'), default=_to_json).encode('utf-8')
+        path = Path(path)
+        if path.suffix == '.gz':
+            import gzip
+            data = gzip.compress(data)
+        path.write_bytes(data)
+
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Load a document model saved with :py:meth:`save`.
+
+        The loaded RstItems are not rendered, use :py:meth:`render` or :py:meth:`write`.
+
+        :param (Path,str) path: the file to load from.
+        :param kwargs: parameters for the RstDocument ctor, overriding the saved ones, e.g.
+            ``width=100``.
+        """
+        import json
+        path = Path(path)
+        data = path.read_bytes()
+        if path.suffix == '.gz':
+            import gzip
+            data = gzip.decompress(data)
+        model = json.loads(data.decode('utf-8'), object_hook=_from_json)
+        kwargs.setdefault('width', model['width'])
+        kwargs.setdefault('headings_numbered_from_level', model['headings_numbered_from_level'])
+        kwargs.setdefault('verbose', False)
+        document = cls(model['name'], **kwargs)
+        document.heading_numbers = model['heading_numbers']
+        document.initial_heading_numbers = model.get('initial_heading_numbers')
+        for state in model['items']:
+            document.items.append(RstItem.from_state(state, document))
+        return document
 
 
 ####################################################################################################
@@ -107,30 +487,198 @@ class RstItem():
 
     Derived classes must:
 
-    * call ``self.rstor()`` at the end of the ctor.
+    * call ``self.finish()`` at the end of the ctor. (Calling ``self.rstor()`` instead, as et_rstor
+      1.2.0 asked, still works, but issues a FutureWarning, see :py:meth:`RstDocument.adopt_unfinished`.)
     * reimplement :py:meth:`rstor()`
+    * list the attributes that determine the rendered ``.rst`` in :py:attr:`source_fields`.
+    * list all their attributes in ``__slots__``.
 
     :param RstDocument document: document to append this RstItem to.
     """
-    default_document = None
+    __slots__ = ('document', 'rst')
+    source_fields = ()
 
     def __init__(self, document):
-        """Create an RstItem and add it to document (if not None)."""
-        if document:
-            self.document = document
-        elif RstItem.default_document:
-            self.document = RstItem.default_document
-        else:
-            self.document = None
+        """Create an RstItem for document (if not None).
 
+        The item is only added to its document by :py:meth:`finish`, when it is complete. Until
+        then, the document keeps it in :py:attr:`RstDocument.unfinished`.
+        """
+        self.rst = None # not rendered yet
+
+        self.document = document or _default_document.get()
+        if self.document:
+            self.document.unfinished[id(self)] = (self, len(self.document.items))
+            if self.document.profiler is not None:
+                self.document.profiler.created(self)
+
+
+    def finish(self):
+        """Render this RstItem and append it to its document (if not None).
+
+        If the document is lazy, rendering is deferred until the document is rendered.
+        Must be called at the end of the ctor of every derived class.
+        """
+        if self.document:
+            self.document.unfinished.pop(id(self), None)
+            if self.document.profiler is not None:
+                self.document.profiler.constructed(self)
+        if not (self.document and self.document.lazy):
+            self.render()
         if self.document:
             self.document.append(self)
 
 
-    def show_progress(self):
-        if self.document.verbose:
-            print(f"\nrstor> {self.__class__.__name__}")
-            print(f"$$$$$$\n{self.rst}$$$$$$\n")
+    def render(self):
+        """Convert this RstItem to ``.rst`` format and show progress."""
+        self._render(show_rst=True)
+
+
+    def _render(self, show_rst):
+        hooked = self.document is not None and self.document.hooked()
+        progress = self.document.progress if self.document else None
+        if progress is not None:
+            progress.begin(self)
+        t0 = time.perf_counter()
+        with self.timed('render'):
+            rst = self.document.call_hooks('before_render', self) if hooked else None
+            if rst is None:
+                self._rstor()
+            else:
+                self.rst = rst
+                if self.document.drop_sources:
+                    self.drop()
+        elapsed = time.perf_counter() - t0
+        if hooked:
+            self.document.call_hooks('after_render', self, elapsed)
+        if progress is not None:
+            progress.end(self, elapsed)
+        self.show_progress(elapsed, show_rst)
+
+
+    def timed(self, phase, **args):
+        """Context manager recording the time the body takes as phase of this RstItem, if its
+        document has a profiler.
+        """
+        if self.document is None or self.document.profiler is None:
+            return _untimed
+        return self.document.profiler.timed(self, phase, **args)
+
+
+    def _rstor(self):
+        """Call :py:meth:`rstor`, unless the result is found in the render cache of the document.
+
+        Drop the source fields afterwards if the document asks so.
+        """
+        self._rstor_cached()
+        if self.document and self.document.drop_sources:
+            self.drop()
+
+
+    def _rstor_cached(self):
+        cache = self.document.cache if self.document else None
+        if cache is None or not self.is_cacheable():
+            self.rstor()
+            return
+        key = self.fingerprint()
+        self.rst = cache.get(key)
+        if self.rst is None:
+            self.rstor()
+            cache.put(key, self.rst)
+
+
+    def drop(self):
+        """Set the :py:attr:`source_fields` to None, to save memory."""
+        for field in self.source_fields:
+            setattr(self, field, None)
+
+
+    def is_cacheable(self):
+        """Whether the rendered ``.rst`` depends only on :py:attr:`source_fields` and the document's
+        text width, i.e. rendering has no side effects and reads no other input.
+
+        By default, RstItems are cacheable if they list their :py:attr:`source_fields`.
+        """
+        return bool(self.source_fields)
+
+
+    def source_digest(self):
+        """Digest of the class (its fully qualified name) and the :py:attr:`source_fields` of this
+        RstItem.
+        """
+        import hashlib
+        h = hashlib.sha256(f'{self.__class__.__module__}.{self.__class__.__qualname__}'.encode('utf-8'))
+        for field in self.source_fields:
+            h.update(f'\0{field}={getattr(self, field)!r}'.encode('utf-8'))
+        return h.hexdigest()
+
+
+    def fingerprint(self):
+        """Key of this RstItem in a :py:class:`RenderCache`.
+
+        Besides the :py:meth:`source_digest`, it depends on the TextWrapper of the document (its
+        class, text width and :py:meth:`TextWrapper.digest`) and the et_rstor version.
+        """
+        textwrapper = self.document.textwrapper
+        return ( f'{self.source_digest()}:{textwrapper.__class__.__name__}:{textwrapper.width}'
+                 f':{textwrapper.digest()}:{__version__}'
+               )
+
+
+    def state(self):
+        """The attributes of this RstItem that are needed to render it again, as a dict: its slots,
+        and the attributes in its ``__dict__``, if its class does not define ``__slots__``.
+
+        See :py:meth:`RstDocument.save`.
+        """
+        state = {'class': f'{self.__class__.__module__}.{self.__class__.__qualname__}'}
+        for cls in self.__class__.__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if not slot in ('document', 'rst'):
+                    state[slot] = getattr(self, slot)
+        for attribute, value in getattr(self, '__dict__', {}).items():
+            if not attribute in ('document', 'rst'):
+                state[attribute] = value
+        return state
+
+
+    @staticmethod
+    def from_state(state, document):
+        """Recreate an RstItem from its :py:meth:`state`, without rendering it.
+
+        :param dict state: the state of the RstItem.
+        :param RstDocument document: the document the RstItem belongs to.
+        :raises ValueError: if the class in state is not an RstItem class.
+        """
+        import importlib
+        module, _, qualname = state['class'].rpartition('.')
+        cls = getattr(importlib.import_module(module), qualname, None)
+        if not (isinstance(cls, type) and issubclass(cls, RstItem)):
+            raise ValueError(f'{state["class"]} is not an RstItem class.')
+        item = object.__new__(cls)
+        for slot, value in state.items():
+            if slot != 'class':
+                setattr(item, slot, value)
+        item.document = document
+        item.rst = None
+        return item
+
+
+    def show_progress(self, elapsed=None, show_rst=True):
+        """Log a line with the time it took to render this RstItem, and its ``.rst``.
+
+        :param float elapsed: the rendering time in seconds. If None, as when derived classes
+            written for v1.2.0 call ``self.show_progress()``, no time is logged.
+        :param bool show_rst: if False, the ``.rst`` is not logged.
+        """
+        if self.document is None:
+            return
+        if elapsed is None:
+            self.document.log(ITEM, f"rstor> {self.__class__.__name__}")
+        else:
+            self.document.log(ITEM, f"rstor> {self.__class__.__name__:<9} {1000*elapsed:9.1f} ms")
+        if show_rst:
+            self.document.log(RST, f"$$$$$$\n{self.rst}$$$$$$")
 
 
     def rstor(self):
@@ -165,28 +713,51 @@ class Heading(RstItem):
                  ,('^',False)
                  ,('"',False)
                  ]
+    __slots__ = ('level', 'parms', 'text', 'val', 'heading', 'crosslink')
+    source_fields = ('heading', 'parms', 'crosslink')
 
     def __init__(self, heading, level=0, val=None, crosslink='', document=None):
         super().__init__(document=document)
+        self.level = level
         self.parms = Heading.parameters[level]
 
-        self.heading = heading.replace('\n', ' ')
-        if level >= self.document.headings_numbered_from_level:
-            if val is None:
-                self.document.heading_numbers[level] += 1
-            else:
-                self.document.heading_numbers[level] = val
-            for l in range(level+1,6):
-                self.document.heading_numbers[l] = 0
-            numbering = ''
-            for l in range(self.document.headings_numbered_from_level,level+1):
-                numbering += f'{self.document.heading_numbers[l]}.'
-            self.heading = f"{numbering} {self.heading}"
+        self.text = heading.replace('\n', ' ')
+        self.val = val
+        self.heading = self.text
+        if self.document.initial_heading_numbers is None:
+            self.document.initial_heading_numbers = list(self.document.heading_numbers)
+        if not self.document.lazy: # lazy documents number their headings when rendered
+            self.heading = self.number()
 
         self.crosslink = crosslink
 
-        self.rstor()
-        self.show_progress()
+        self.finish()
+
+
+    def number(self):
+        """Advance the heading numbers of the document for this Heading.
+
+        :return: the heading text, prefixed with its number if its level is numbered.
+        """
+        level = self.level
+        if level < self.document.headings_numbered_from_level:
+            return self.text
+        if self.val is None:
+            self.document.heading_numbers[level] += 1
+        else:
+            self.document.heading_numbers[level] = self.val
+        for l in range(level+1,6):
+            self.document.heading_numbers[l] = 0
+        numbering = ''
+        for l in range(self.document.headings_numbered_from_level,level+1):
+            numbering += f'{self.document.heading_numbers[l]}.'
+        return f"{numbering} {self.text}"
+
+
+    def drop(self):
+        """Set the :py:attr:`source_fields`, and the unnumbered heading text, to None."""
+        super().drop()
+        self.text = None
 
 
     def rstor(self):
@@ -209,13 +780,15 @@ class Heading(RstItem):
 # Paragraph
 ####################################################################################################
 class Paragraph(RstItem):
+    __slots__ = ('text', 'width', 'indent')
+    source_fields = ('text', 'indent')
+
     def __init__(self, text, width=72, indent=0, document=None):
         super().__init__(document=document)
         self.text = text
         self.width = width
         self.indent = indent*' '
-        self.rstor()
-        self.show_progress()
+        self.finish()
 
 
     def rstor(self):
@@ -230,11 +803,13 @@ class Paragraph(RstItem):
 # Note
 ####################################################################################################
 class Note(RstItem):
+    __slots__ = ('paragraphs',)
+    source_fields = ('paragraphs',)
+
     def __init__(self, text, document=None):
         super().__init__(document=document)
         self.paragraphs = listify(text)
-        self.rstor()
-        self.show_progress()
+        self.finish()
 
 
     def rstor(self):
@@ -250,11 +825,15 @@ class Note(RstItem):
 # Include
 ####################################################################################################
 class Include(RstItem):
+    __slots__ = ('include_file',)
+    source_fields = ('include_file',)
+
     def __init__(self, filename, document=None):
         super().__init__(document=document)
         self.include_file = filename
-        self.rstor()
-        self.show_progress()
+        if self.document:
+            self.document.add_input(filename, relative_to_document=True)
+        self.finish()
 
 
     def rstor(self):
@@ -265,11 +844,15 @@ class Include(RstItem):
 # Image
 ####################################################################################################
 class Image(RstItem):
+    __slots__ = ('filepath',)
+    source_fields = ('filepath',)
+
     def __init__(self, filepath, document=None):
         super().__init__(document=document)
         self.filepath = filepath
-        self.rstor()
-        self.show_progress()
+        if self.document:
+            self.document.add_input(filepath, relative_to_document=True)
+        self.finish()
 
 
     def rstor(self):
@@ -280,14 +863,16 @@ class Image(RstItem):
 # List
 ####################################################################################################
 class List(RstItem):
+    __slots__ = ('items', 'numbered', 'indent')
+    source_fields = ('items', 'numbered', 'indent')
+
     def __init__(self, items, numbered=False, indent=0, document=None):
         """List item, bullets or numbered"""
         super().__init__(document=document)
         self.items = listify(items)
         self.numbered = numbered
         self.indent = indent*' '
-        self.rstor()
-        self.show_progress()
+        self.finish()
 
 
     def rstor(self):
@@ -304,6 +889,42 @@ class List(RstItem):
 ####################################################################################################
 # CodeBlock
 ####################################################################################################
+_pycon_session = r"""
+import io, json, os, sys, time, traceback
+request = json.loads(sys.stdin.read())
+sys.path[:] = [os.getcwd()] + [path for path in request['path'] if path != os.getcwd()]
+results = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+os.dup2(2, 1) # output that bypasses sys.stdout goes to stderr
+namespace = {'__name__': '__main__', 'sys': sys, 'os': os}
+outputs = []
+error = None
+t0 = time.perf_counter()
+for line in request['lines']:
+    sys.stdout, sys.stderr = stdout, stderr = io.StringIO(), io.StringIO()
+    start = time.perf_counter()
+    try:
+        exec(line, namespace)
+    except BaseException as exception:
+        message = ''.join(traceback.format_exception( type(exception), exception
+                                                    , exception.__traceback__.tb_next))
+        if request['error_ok']:
+            print(message)
+        else:
+            error = message
+    seconds = time.perf_counter() - start
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    outputs.append((stdout.getvalue(), stderr.getvalue(), start - t0, seconds))
+    if error is not None:
+        break
+json.dump({'outputs': outputs, 'error': error}, results)
+results.close()
+"""
+"""Python program executing the statements of a pycon CodeBlock in a subprocess, see
+:py:meth:`CodeBlock.run`. It reads the statements from stdin and writes the output, start and
+duration of each statement to stdout, as JSON.
+"""
+
+
 class CodeBlock(RstItem):
     """Rst code-block directive.
 
@@ -311,6 +932,9 @@ class CodeBlock(RstItem):
     :param str language: language of the commands
     :param bool execute: if True, execute the commands and add the output to the text. If False
         the lines are printed literally, no prompt is added.
+    :param (Path,str) cwd: directory to execute the commands in, default the current working
+        directory. If given, its files are recorded as inputs of the document (see
+        :py:meth:`RstDocument.add_input`).
     :param bool error_ok: if True, exceptions raised will be absorbed by the .rst text instead
         of propagated to Python (which will abort the script)
     :param str prompt: prompt to appear in front of the commands or statements, ignored if execute==False.
@@ -320,23 +944,31 @@ class CodeBlock(RstItem):
     :param callable() setup: function that has to be executed before the command lines.
     :param callable() cleanup: function that has to be executed before the command lines.
 
-    .. warning::
+    .. note::
 
-            language=='pycon': if a module has been modified it must be reloaded (importlib.reload).
-            However, reloading a binary extension does not work. the CodeBlock must be executed in
-            a separate Python session.
+            language=='pycon': every CodeBlock is executed in a Python session of its own, so
+            modules that were modified (binary extensions too) need not be reloaded.
     """
 
     default_prompts = { 'bash': '> '
                       , 'python': ''
                       , 'pycon': '>>> '
                       }
+    default_language = 'bash'
+    """Language in which CodeBlocks without a language are executed. Their code-block directive
+    keeps the empty language.
+    """
+    __slots__ = ( 'lines', 'language', 'prompt', 'indent', 'execute', 'cwd', 'error_ok'
+                , 'stdout', 'stderr', 'hide', 'copyto', 'copyfrom', 'filter', 'append'
+                , 'setup', 'cleanup', 'outputs'
+                )
+    source_fields = ('lines', 'language', 'prompt', 'indent', 'hide')
 
     def __init__( self
                 , lines=[]
                 , language=''
                 , execute=False
-                , cwd='.'
+                , cwd=None
                 , error_ok=False
                 , stdout=True
                 , stderr=True
@@ -359,7 +991,7 @@ class CodeBlock(RstItem):
 
         self.indent = indent*' '
         self.execute = execute
-        self.cwd = cwd
+        self.cwd = Path('.' if cwd is None else cwd).resolve()
         self.error_ok = error_ok
         self.stdout = stdout
         self.stderr = stderr
@@ -370,24 +1002,54 @@ class CodeBlock(RstItem):
         self.append = append
         self.setup = setup
         self.cleanup = cleanup
+        self.outputs = None # not executed yet
 
-        if self.document.verbose:
-            print(f"\nrstor> {self.__class__.__name__}{' (hidden)' if self.hide else ''}")
+        if self.copyfrom:
+            self.document.add_input(self.copyfrom)
+        if self.execute and cwd is not None:
+            self.document.add_input(cwd, tree=True)
 
-        self.rstor()
+        self.finish()
 
-        if self.document.verbose and not self.hide:
-            print(f"$$$$$$\n{self.rst}$$$$$$\n")
 
+    def render(self):
+        """Convert this CodeBlock to ``.rst`` format, executing it if requested, and show progress.
 
-    def rstor(self):
-        self.rst = ''
+        The ``.rst`` of a hidden CodeBlock is not shown.
+        """
+        self._render(show_rst=not self.hide)
 
-        if not self.hide:
-            self.rst = f'.. code-block:: {self.language}\n\n'
 
+    def state(self):
+        """The state of a CodeBlock that is rendered is saved with the lines read from copyfrom, and
+        without setup, cleanup, filter and copyto, which must not run again on re-rendering.
+        """
+        state = super().state()
+        if self.rst is not None:
+            for slot in ('copyfrom', 'filter', 'copyto', 'setup', 'cleanup'):
+                state[slot] = None
+        elif any(callable(state[slot]) for slot in ('filter', 'setup', 'cleanup')):
+            raise ValueError('A CodeBlock with callables can only be saved after it is rendered.')
+        return state
+
+
+    def drop(self):
+        """Set the :py:attr:`source_fields`, the captured output, and the callables and files used
+        for rendering, to None.
+        """
+        super().drop()
+        for field in ('outputs', 'setup', 'cleanup', 'filter', 'copyto'):
+            setattr(self, field, None)
+
+
+    def is_cacheable(self):
+        """Only CodeBlocks that are not executed and do not read or write files are cacheable."""
+        return not (self.execute or self.copyfrom or self.copyto)
+
+
+    def rstor(self):
         if self.copyfrom:
-            with self.copyfrom.open(mode='r') as f:
+            with self.timed('read'), self.copyfrom.open(mode='r') as f:
                 self.lines = f.readlines()
             # Remove trailing newlines and withspace
             for l,line in enumerate(self.lines):
@@ -396,76 +1058,36 @@ class CodeBlock(RstItem):
                 self.lines = self.filter(self.lines)
 
         if self.execute:
-            if not self.language:
-                self.language='bash' # default
+            if self.outputs is None:
+                self.run()
 
-            if self.setup:
-                self.setup()
-            if self.language == 'bash':
-                for line in self.lines:
-                    print(f"{self.language}@ {line}")
+            self.rst = ''
+            if not self.hide:
+                self.rst = f'.. code-block:: {self.language}\n\n'
+
+            if (self.language or self.default_language) == 'bash':
+                for line, (output, _) in zip(self.lines, self.outputs):
                     if not self.hide:
                         self.rst += f'{self.indent}{self.prompt}{line}\n'
-                    # execute the command and add its output
-                    self.stdout = subprocess.PIPE if self.stdout else None
-                    self.stderr = subprocess.STDOUT if self.stderr else None
-                    completed_process = subprocess.run( line
-                                                      , cwd=self.cwd
-                                                      , stdout=self.stdout
-                                                      , stderr=self.stderr
-                                                      , shell=True
-                                                      )
-                    output = completed_process.stdout.decode('utf-8')
-                    if not self.hide:
                         if self.indent:
                             output = self.indent + output.replace('\n', '\n'+self.indent)
                         self.rst += output+'\n'
 
-                    if completed_process.returncode and not self.error_ok:
-                        print(output)
-                        raise RuntimeError()
-
-            elif self.language == 'pycon':
-                sys.path.insert(0,'.')
-                # print(self.cwd)
-                with in_directory(self.cwd):
-                    output = ''
-                    for line in self.lines:
-                        print(f"{self.language}@ {line}") # show progress
-                        hide_line = '#hide#' in line
-                        hide_stdout = '#hide_stdout#' in line
-                        hide_stderr = '#hide_stderr#' in line
-                        str_stdout = io.StringIO()
-                        str_stderr = io.StringIO()
-                        with redirect_stderr(str_stderr):
-                            with redirect_stdout(str_stdout):
-                                if not hide_line:
-                                    output += f"{self.prompt}{line}\n"
-                                try:
-                                    exec(line)
-                                except:
-                                    if self.error_ok:
-                                        print(traceback.format_exc())
-                                    else:
-                                        raise
-                                o = str_stdout.getvalue()
-                                if o and not hide_stdout:
-                                    output += o
-                                e = str_stderr.getvalue()
-                                if e and not hide_stderr:
-                                    output += e
-
-                    # indent the output if necessary
-                    if self.indent:
-                        output = self.indent + output.replace('\n', '\n' + self.indent)
-
-                    self.rst += output
-
-            else:
-                raise NotImplementedError()
-
-            if self.cleanup:
-                self.cleanup()
+            else: # pycon
+                output = ''
+                for line, (o, e) in zip(self.lines, self.outputs):
+                    if not '#hide#' in line:
+                        output += f"{self.prompt}{line}\n"
+                    if o and not '#hide_stdout#' in line:
+                        output += o
+                    if e and not '#hide_stderr#' in line:
+                        output += e
+
+                # indent the output if necessary
+                if self.indent:
+                    output = self.indent + output.replace('\n', '\n' + self.indent)
+
+                self.rst += output
         else:
             self.rst = f'.. code-block:: {self.language}\n\n'
             for line in self.lines:
@@ -477,11 +1099,98 @@ class CodeBlock(RstItem):
         if self.copyto :
             self.copyto.parent.mkdir(parents=True,exist_ok=True)
             mode = 'a+' if self.append else 'w'
-            with self.copyto.open(mode=mode) as f:
+            with self.timed('copyto'), self.copyto.open(mode=mode) as f:
                 for line in self.lines:
                     f.write(line + '\n')
 
 
+    def run(self):
+        """Execute the lines, and store the (stdout, stderr) output of each line in :py:attr:`outputs`.
+
+        The process wide state (current working directory, sys.path, sys.modules, sys.stdout)
+        is left untouched, so that CodeBlocks of different documents can be executed concurrently
+        in threads. Bash commands are run in a subprocess with ``cwd``. Pycon statements are
+        executed in a Python subprocess (see :py:data:`_pycon_session`) with ``cwd`` as current
+        working directory, prepended to the sys.path of this process, and in a namespace
+        containing ``sys`` and ``os``.
+        """
+        hooked = self.document.hooked()
+        t0 = time.perf_counter()
+        outputs = self.document.call_hooks('before_execute', self) if hooked else None
+        if outputs is None:
+            if self.setup:
+                with self.timed('setup'):
+                    self.setup()
+
+            with self.timed('execute'):
+                self._execute_lines()
+
+            if self.cleanup:
+                with self.timed('cleanup'):
+                    self.cleanup()
+        else:
+            self.outputs = list(outputs)
+        if hooked:
+            self.document.call_hooks('after_execute', self, time.perf_counter() - t0)
+
+
+    def _execute_lines(self):
+        self.outputs = []
+        language = self.language or self.default_language
+        if language == 'bash':
+            import subprocess
+            stdout = subprocess.PIPE if self.stdout else None
+            stderr = subprocess.STDOUT if self.stderr else None
+            for line in self.lines:
+                self.document.log(RST, f"{language}@ {line}")
+                # execute the command and capture its output
+                with self.timed('command', command=line):
+                    completed_process = subprocess.run( line
+                                                      , cwd=self.cwd
+                                                      , stdout=stdout
+                                                      , stderr=stderr
+                                                      , shell=True
+                                                      )
+                output = completed_process.stdout.decode('utf-8') if stdout else ''
+                self.outputs.append((output, ''))
+
+                if completed_process.returncode and not self.error_ok:
+                    raise RuntimeError( f'Command {line!r} failed with exit code '
+                                        f'{completed_process.returncode}.\n{output}'
+                                      )
+
+        elif language == 'pycon':
+            import json
+            import subprocess
+            for line in self.lines:
+                self.document.log(RST, f"{language}@ {line}")
+            request = { 'lines': self.lines
+                      , 'error_ok': self.error_ok
+                      , 'path': [os.path.abspath(path) for path in sys.path]
+                      }
+            t0 = time.perf_counter()
+            completed_process = subprocess.run( [sys.executable, '-c', _pycon_session]
+                                              , input=json.dumps(request).encode('utf-8')
+                                              , cwd=self.cwd
+                                              , stdout=subprocess.PIPE
+                                              )
+            try:
+                result = json.loads(completed_process.stdout.decode('utf-8'))
+            except ValueError:
+                raise RuntimeError( f'The Python session in {self.cwd} failed with exit code '
+                                    f'{completed_process.returncode}.'
+                                  ) from None
+            profiler = self.document.profiler
+            for line, (stdout, stderr, start, seconds) in zip(self.lines, result['outputs']):
+                self.outputs.append((stdout, stderr))
+                if profiler is not None:
+                    profiler.record(self, 'command', seconds, start=t0 + start, command=line)
+            if result['error'] is not None:
+                raise RuntimeError(f'Statement {line!r} failed.\n{result["error"]}')
+
+        else:
+            raise NotImplementedError()
+
 
 class Table(RstItem):
     """ Table class
@@ -489,6 +1198,9 @@ class Table(RstItem):
     :param list-of-lists rows: a list of rows, each row being a list as well. First row is
         title row.
     """
+    __slots__ = ('rows', 'indent')
+    source_fields = ('rows', 'indent')
+
     def __init__(self
                 , rows
                 , document=None
@@ -496,8 +1208,7 @@ class Table(RstItem):
         super().__init__(document=document)
         self.rows = rows
         self.indent = 4*' '
-        self.rstor()
-        self.show_progress()
+        self.finish()
 
     def rstor(self):
         self.rst = ''
@@ -507,24 +1218,19 @@ class Table(RstItem):
             if len(row) != ncols:
                 raise ValueError('all rows must have the same number of columns')
         # Convert rows to str and find out the width of each column
+        rows = [[str(val) for val in row] for row in self.rows]
         wcol = ncols*[0]
-        for row in self.rows:
-            for c,val in enumerate(row):
-                sval = str(val)
-                row[c] = sval
+        for row in rows:
+            for c,sval in enumerate(row):
                 w = len(sval)
                 wcol[c] = max(w,wcol[c])
         # Insert lines
-        self.rows.insert(0, [])
-        self.rows.insert(2, [])
-        self.rows.append([])
-        for c in range(ncols):
-            line = wcol[c]*'='
-            self.rows[ 0].append(line)
-            self.rows[ 2].append(line)
-            self.rows[-1].append(line)
+        lines = [wcol[c]*'=' for c in range(ncols)]
+        rows.insert(0, lines)
+        rows.insert(2, lines)
+        rows.append(lines)
         # compile table in rst format:
-        for row in self.rows:
+        for row in rows:
             self.rst += '\n' + self.indent
             for c,val in enumerate(row):
                 self.rst += val.ljust(wcol[c]+2)
@@ -532,9 +1238,754 @@ class Table(RstItem):
         self.rst += '\n\n'
 
 
+####################################################################################################
+# RenderCache
+####################################################################################################
+class RenderCache:
+    """Persistent cache mapping RstItem fingerprints to rendered ``.rst``.
+
+    The cache is an sqlite database. When its total size exceeds max_size, the least recently used
+    entries are evicted.
+
+    The database can be shared by builds in parallel processes. It is opened in WAL mode, so that
+    reading never waits for a writer, and :py:meth:`get` does not write. New entries, and the
+    recency of the entries that were found, are written in short transactions: every batch_size
+    :py:meth:`put` calls, when the size exceeds max_size, and by :py:meth:`commit` (called by
+    :py:meth:`RstDocument.write`) and :py:meth:`close`. A writer waits at most timeout seconds
+    for the others.
+
+    A RenderCache can be shared by documents that are built in different threads: the connection
+    is used by one thread at a time.
+
+    :param (Path,str) path: location of the sqlite database file.
+    :param int max_size: maximum total size of the cached ``.rst`` strings, in characters.
+    :param int batch_size: number of new entries written per transaction.
+    :param float timeout: seconds to wait for a lock on the database.
+    """
+    def __init__(self, path='.et_rstor_cache.sqlite', max_size=64*1024*1024, batch_size=100, timeout=60.0):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = {} # key -> rst, not written yet
+        self.touched = {} # key -> used, not written yet
+
+        import sqlite3
+        self.connection = sqlite3.connect(str(self.path), timeout=timeout, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute( 'CREATE TABLE IF NOT EXISTS items'
+                                 '(key TEXT PRIMARY KEY, rst TEXT, size INTEGER, used INTEGER)'
+                               )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS items_used ON items(used)')
+        self.connection.commit()
+        size, used = self.connection.execute('SELECT SUM(size), MAX(used) FROM items').fetchone()
+        self.size = size or 0
+        self.used = used or 0
+
+
+    def get(self, key):
+        """Return the ``.rst`` cached for key, or None."""
+        with self.lock:
+            rst = self.pending.get(key)
+            if rst is None:
+                row = self.connection.execute('SELECT rst FROM items WHERE key=?', (key,)).fetchone()
+                rst = row[0] if row else None
+            if rst is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used += 1
+            self.touched[key] = self.used
+            return rst
+
+
+    def put(self, key, rst):
+        """Store the ``.rst`` for key, and evict least recently used entries if necessary."""
+        with self.lock:
+            old = self.pending.get(key)
+            if old is None:
+                row = self.connection.execute('SELECT size FROM items WHERE key=?', (key,)).fetchone()
+                old = row and row[0]
+            else:
+                old = len(old)
+            if old:
+                self.size -= old
+            self.pending[key] = rst
+            self.size += len(rst)
+            if len(self.pending) >= self.batch_size or self.size > self.max_size:
+                self._commit()
+
+
+    def evict(self, max_size):
+        """Evict least recently used entries until the total size is at most max_size."""
+        with self.lock:
+            self._commit()
+            self._evict(max_size)
+            self.connection.commit()
+
+
+    def _evict(self, max_size):
+        keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM items ORDER BY used'):
+            if self.size <= max_size:
+                break
+            keys.append((key,))
+            self.size -= size
+        self.connection.executemany('DELETE FROM items WHERE key=?', keys)
+
+
+    def _commit(self):
+        if not (self.pending or self.touched):
+            return
+        rows = []
+        for key, rst in self.pending.items():
+            self.used += 1
+            rows.append((key, rst, len(rst), self.used))
+        with self.connection: # a transaction
+            self.connection.executemany('INSERT OR REPLACE INTO items VALUES (?,?,?,?)', rows)
+            self.connection.executemany( 'UPDATE items SET used=? WHERE key=?'
+                                       , [(used, key) for key, used in self.touched.items()]
+                                       )
+            if self.size > self.max_size:
+                self._evict(self.max_size)
+        self.pending.clear()
+        self.touched.clear()
+
+
+    def hit_rate(self):
+        """Fraction of :py:meth:`get` calls that found an entry."""
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+
+    def commit(self):
+        """Write the new entries, and the recency of the entries found, to the database."""
+        with self.lock:
+            self._commit()
+
+
+    def close(self):
+        """Commit the changes and close the database."""
+        with self.lock:
+            self._commit()
+            self.connection.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+####################################################################################################
+# Hooks
+####################################################################################################
+class Hooks:
+    """Registry of functions (hooks) that are called on the events of building RstDocuments.
+
+    The hooks in the global registry :py:data:`hooks` are called for every RstDocument, before
+    the hooks in the registry :py:attr:`RstDocument.hooks` of the document itself. The events,
+    and the arguments the hooks receive, are:
+
+    * ``before_render(item)``: before an RstItem is rendered. If a hook returns a str, it is used
+      as the ``.rst`` of the item, and the item is not rendered.
+    * ``after_render(item, elapsed)``: after an RstItem is rendered, in elapsed seconds.
+    * ``before_execute(codeblock)``: before the lines of a CodeBlock are executed. If a hook returns
+      a list of (stdout, stderr) tuples, one per line, it is used as the output of the lines, and
+      nothing is executed (including setup and cleanup).
+    * ``after_execute(codeblock, elapsed)``: after a CodeBlock is executed, in elapsed seconds.
+    * ``before_write(document)``: before a document is written. The hook may modify
+      ``document.rst``, unless the document is streamed or split.
+
+    If several hooks return a result, the first one is used.
+    """
+    events = ('before_render', 'after_render', 'before_execute', 'after_execute', 'before_write')
+
+    def __init__(self):
+        for event in Hooks.events:
+            setattr(self, event, [])
+        self.n_hooks = 0
+
+
+    def register(self, event, hook=None):
+        """Register hook for event.
+
+        Can be used as a decorator: ``@hooks.register('after_render')``.
+
+        :return: hook.
+        """
+        if not event in Hooks.events:
+            raise ValueError(f'Unknown event {event!r}.')
+        if hook is None:
+            return lambda hook: self.register(event, hook)
+        getattr(self, event).append(hook)
+        self.n_hooks += 1
+        return hook
+
+
+    def unregister(self, event, hook):
+        """Remove hook for event."""
+        getattr(self, event).remove(hook)
+        self.n_hooks -= 1
+
+
+    def __bool__(self):
+        return self.n_hooks > 0
+
+
+hooks = Hooks()
+"""Global registry of hooks, called for every RstDocument."""
+
+
+####################################################################################################
+# ProgressBar
+####################################################################################################
+class ProgressBar:
+    """Live progress line for building RstDocuments.
+
+    The line shows the RstItem being rendered, the percentage done and the estimated remaining
+    time (ETA). Both are computed from the durations of the RstItems in the previous build, which
+    are stored in a JSON file per document, keyed by the :py:meth:`RstItem.source_digest` of the
+    items. Items that were not in the previous build count as taking no time. As every document
+    has its own file, documents can be built in parallel processes.
+
+    If the stream is a terminal, a single line is updated in place. Otherwise, a line is logged
+    for every RstItem (see :py:func:`progress_logger`).
+
+    :param (Path,str) path: directory of the JSON files with the durations, ``<name>.json`` for
+        the document ``<name>``.
+    :param stream: text stream to show the progress line on, default is ``sys.stdout``.
+    """
+    def __init__(self, path='.et_rstor_timings', stream=None):
+        self.path = Path(path)
+        self.stream = stream
+        self.builds = {} # document name -> state of the build of that document
+
+
+    def previous(self, name):
+        """The durations of the previous build of document name, as a dict mapping item identities
+        to durations.
+        """
+        import json
+        try:
+            return json.loads((self.path / f'{name}.json').read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+
+    def begin(self, item):
+        """Show that item is being rendered."""
+        document = item.document
+        build = self.builds.get(document.name)
+        if build is None:
+            expected = self.previous(document.name)
+            build = self.builds[document.name] = { 'expected': expected
+                                                 , 'total': sum(expected.values())
+                                                 , 'done': 0.0
+                                                 , 'durations': {}
+                                                 , 'counts': {} # source digest -> number of items
+                                                 }
+        identity = item.source_digest()
+        n = build['counts'].get(identity, 0)
+        build['counts'][identity] = n + 1
+        build['identity'] = f'{identity}:{n}' # identical items are numbered in order
+        build['durations'][build['identity']] = None
+        if build['total']:
+            percentage = f"{100*min(build['done']/build['total'], 1):3.0f}%"
+            eta = f"ETA {max(build['total'] - build['done'], 0):.0f} s"
+        else:
+            percentage = '  ?%'
+            eta = f"{len(build['durations'])} items"
+        self.show(f'[{percentage}] {document.name}: {self.label(item)}  {eta}')
+
+
+    def end(self, item, elapsed):
+        """Record the time it took to render item."""
+        build = self.builds[item.document.name]
+        build['durations'][build['identity']] = elapsed
+        build['done'] += build['expected'].get(build['identity'], 0.0)
+
+
+    def finish(self, document):
+        """End the progress line of document, and store the durations of its items."""
+        build = self.builds.pop(document.name, None)
+        if build is None:
+            return
+        self.show(f'[100%] {document.name}: {len(build["durations"])} items', end=True)
+        import json
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.path / f'{document.name}.json'
+        with open_temporary(path) as f:
+            f.write(json.dumps(build['durations'], indent=1).encode('utf-8'))
+        os.replace(f.name, path)
+
+
+    def label(self, item):
+        """Short description of item: its class and the beginning of its source."""
+        field = getattr(item, item.source_fields[0], None) if item.source_fields else None
+        if isinstance(field, (list, tuple)):
+            field = field[0] if field else None
+        text = ' '.join(str(field).split()) if field is not None else ''
+        return f'{item.__class__.__name__} {text[:40]}'
+
+
+    def show(self, line, end=False):
+        """Show line, in place of the previous line if the stream is a terminal."""
+        stream = self.stream or sys.stdout
+        if stream.isatty():
+            import shutil
+            width = shutil.get_terminal_size().columns - 1
+            stream.write(f'\r{line[:width]}\x1b[K' + ('\n' if end else ''))
+            stream.flush()
+        else:
+            progress_logger().log(SUMMARY if end else ITEM, line)
+
+
+####################################################################################################
+# Profiler
+####################################################################################################
+_untimed = nullcontext()
+
+
+class Profiler:
+    """Time spent in the phases of building RstDocuments, per RstItem.
+
+    The phases of an RstItem are:
+
+    * ``construct``: from the start of its ctor until it is rendered,
+    * ``render``: converting it to ``.rst``, including the phases below,
+    * ``read``: reading the ``copyfrom`` file of a CodeBlock,
+    * ``setup``, ``execute``, ``cleanup``: executing a CodeBlock,
+    * ``command``: executing one line of a CodeBlock, part of ``execute``,
+    * ``copyto``: writing the ``copyto`` file of a CodeBlock.
+
+    The phases of a document are ``write``: writing its file(s), and ``build``: from its creation
+    until it is written.
+
+    Every RstItem is reported with the source location (``file:line``) where it was created.
+    """
+    def __init__(self):
+        self.records = []
+        self.current = {} # id(item) -> record of the item
+        self.started = {} # id(item) -> start of construction
+        self.documents = {} # document name -> {phase: seconds}
+
+
+    def created(self, item):
+        """Start timing the construction of item, and record where it is created."""
+        frame = sys._getframe(1)
+        while frame and frame.f_globals.get('__name__') == __name__:
+            frame = frame.f_back
+        location = f'{frame.f_code.co_filename}:{frame.f_lineno}' if frame else None
+        self.current[id(item)] = self._new_record(item, location)
+        self.started[id(item)] = time.perf_counter()
+
+
+    def constructed(self, item):
+        """Stop timing the construction of item."""
+        t0 = self.started.pop(id(item), None)
+        if t0 is not None:
+            self.record(item, 'construct', time.perf_counter() - t0, start=t0)
+
+
+    def _new_record(self, item, location):
+        record = { 'document': item.document.name
+                 , 'item': item.__class__.__name__
+                 , 'location': location
+                 , 'phases': {}
+                 }
+        self.records.append(record)
+        return record
+
+
+    def record(self, item_or_document, phase, seconds, start=None, **args):
+        """Add seconds to the time spent in phase by an RstItem or an RstDocument.
+
+        :param float start: the time.perf_counter() value at the start of the phase.
+        :param args: details of the phase, e.g. the command executed. Ignored by the Profiler.
+        """
+        if isinstance(item_or_document, RstDocument):
+            phases = self.documents.setdefault(item_or_document.name, {})
+        else:
+            record = self.current.get(id(item_or_document))
+            if record is None: # e.g. a loaded item
+                record = self.current[id(item_or_document)] = self._new_record(item_or_document, None)
+            phases = record['phases']
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+    @contextmanager
+    def timed(self, item_or_document, phase, **args):
+        """Context manager recording the time the body takes as phase of item_or_document."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(item_or_document, phase, time.perf_counter() - t0, start=t0, **args)
+
+
+    def as_dict(self, n=None, document=None):
+        """The profile as a dict, with the n slowest items, slowest first.
+
+        :param int n: number of items to report, all if None.
+        :param str document: report only on the document with this name, if not None.
+        """
+        records = [r for r in self.records if document is None or r['document'] == document]
+        for record in records:
+            phases = record['phases']
+            record['seconds'] = phases.get('construct', 0.0) + phases.get('render', 0.0)
+        records.sort(key=lambda r: r['seconds'], reverse=True)
+        phases = {}
+        for record in records:
+            for phase, seconds in record['phases'].items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+        documents = {name: doc_phases for name, doc_phases in self.documents.items()
+                     if document is None or name == document}
+        for doc_phases in documents.values():
+            for phase, seconds in doc_phases.items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+        return { 'n_items': len(records)
+               , 'phases': dict(sorted(phases.items(), key=lambda kv: kv[1], reverse=True))
+               , 'documents': documents
+               , 'items': records[:n]
+               }
+
+
+    def report(self, n=20, document=None, format='text'):
+        """Report of the time spent per phase and of the n slowest items.
+
+        :param int n: number of items to report, all if None.
+        :param str document: report only on the document with this name, if not None.
+        :param str format: 'text' or 'json'.
+        :return: the report as a str.
+        """
+        profile = self.as_dict(n=n, document=document)
+        if format == 'json':
+            import json
+            return json.dumps(profile, indent=1)
+        if format != 'text':
+            raise ValueError(f'Unknown format {format!r}.')
+        return '\n'.join(self.format(profile)) + '\n'
+
+
+    def format(self, profile):
+        """The lines of the text report of profile, see :py:meth:`as_dict`."""
+        lines = [f"Profile of {profile['n_items']} items"]
+        lines.append(f"{'phase':<10} {'seconds':>9}")
+        for phase, seconds in profile['phases'].items():
+            lines.append(f'{phase:<10} {seconds:9.4f}')
+        lines.append('')
+        lines.append(f"{'seconds':>9} {'item':<10} {'document':<16} phases / location")
+        for record in profile['items']:
+            phases = ', '.join(f'{phase} {seconds:.4f}' for phase, seconds in record['phases'].items())
+            lines.append(f"{record['seconds']:9.4f} {record['item']:<10} {record['document']:<16} {phases}")
+            lines.append(f"{'':38}{record['location']}")
+        return lines
+
+
+class MemoryProfiler(Profiler):
+    """Profiler that also records the memory allocated by every RstItem, with tracemalloc.
+
+    For the ``construct`` and ``render`` phases (the latter includes the execution of CodeBlocks)
+    of every RstItem, the net allocation (memory still allocated at the end of the phase) and
+    the peak allocation (maximum during the phase), relative to the start of the phase, are
+    recorded. :py:meth:`report` adds the items with the largest peak, and the source lines that
+    allocated most memory since the profiler was created.
+
+    Tracing memory slows down Python considerably, hence it is opt-in. The allocations of all
+    threads are traced, so the numbers are only meaningful if one document is built at a time.
+    Before Python 3.9, the peak of tracemalloc cannot be reset. The peak of a phase is then only
+    known if it is a new maximum since tracing started, otherwise the memory allocated at the end
+    of the phase is reported as its peak.
+
+    :param int frames: number of frames stored per traced allocation, see ``tracemalloc.start``.
+    """
+    memory_phases = ('construct', 'render')
+
+    def __init__(self, frames=1):
+        super().__init__()
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.baseline = tracemalloc.take_snapshot()
+        self.local = threading.local() # stack of phases being measured
+
+
+    def stop(self):
+        """Stop tracing memory allocations."""
+        import tracemalloc
+        tracemalloc.stop()
+
+
+    def begin(self):
+        """Start measuring the memory allocated in a phase. Phases can be nested."""
+        import tracemalloc
+        stack = self.local.__dict__.setdefault('stack', [])
+        current, peak = tracemalloc.get_traced_memory()
+        if stack: # the peak is reset, so remember it for the enclosing phase
+            MemoryProfiler.update_peak(stack[-1], current, peak)
+        reset_peak = getattr(tracemalloc, 'reset_peak', None) # Python 3.9+
+        if reset_peak is not None:
+            reset_peak()
+            peak = current
+        stack.append([current, current, peak]) # start, peak, peak of tracemalloc at the start
+
+
+    @staticmethod
+    def update_peak(phase, current, peak):
+        """Raise the peak of phase (a [start, peak, peak of tracemalloc at the start] list) to the
+        current and peak memory reported by tracemalloc. The peak of tracemalloc only counts if it
+        was reached after the phase started.
+        """
+        phase[1] = max(phase[1], peak if peak > phase[2] else current)
+
+
+    def end(self, item, phase):
+        """Stop measuring the memory allocated in phase by item, and record it."""
+        import tracemalloc
+        stack = self.local.stack
+        current, peak = tracemalloc.get_traced_memory()
+        MemoryProfiler.update_peak(stack[-1], current, peak)
+        start, phase_peak, _ = stack.pop()
+        if stack:
+            stack[-1][1] = max(stack[-1][1], phase_peak)
+        record = self.current.get(id(item))
+        if record is not None:
+            memory = record.setdefault('memory', {})
+            memory[phase] = {'net': current - start, 'peak': phase_peak - start}
+
+
+    def created(self, item):
+        super().created(item)
+        self.begin()
+
+
+    def constructed(self, item):
+        if id(item) in self.started:
+            self.end(item, 'construct')
+        super().constructed(item)
+
+
+    @contextmanager
+    def timed(self, item_or_document, phase, **args):
+        if phase not in MemoryProfiler.memory_phases or isinstance(item_or_document, RstDocument):
+            with super().timed(item_or_document, phase, **args):
+                yield
+            return
+        self.begin()
+        try:
+            with super().timed(item_or_document, phase, **args):
+                yield
+        finally:
+            self.end(item_or_document, phase)
+
+
+    def as_dict(self, n=None, document=None):
+        """The profile as a dict, see :py:meth:`Profiler.as_dict`, with two more entries:
+
+        * ``memory``: the n items with the largest peak allocation, largest first,
+        * ``lines``: the n source lines that allocated most memory, as (location, bytes) tuples.
+        """
+        import tracemalloc
+        profile = super().as_dict(n=None, document=document)
+        items = [r for r in profile['items'] if 'memory' in r]
+        for record in items:
+            record['peak'] = max(m['peak'] for m in record['memory'].values())
+        items.sort(key=lambda r: r['peak'], reverse=True)
+        profile['items'] = profile['items'][:n]
+        profile['memory'] = items[:n]
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        stats = snapshot.compare_to(self.baseline, 'lineno')[:n]
+        profile['lines'] = [(f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}', stat.size_diff)
+                            for stat in stats]
+        return profile
+
+
+    def format(self, profile):
+        lines = super().format(profile)
+        lines.append('')
+        lines.append(f"{'peak':>12} {'net':>12} {'item':<10} {'document':<16} location")
+        for record in profile['memory']:
+            net = sum(m['net'] for m in record['memory'].values())
+            lines.append( f"{record['peak']:12d} {net:12d} {record['item']:<10} {record['document']:<16}"
+                          f" {record['location']}"
+                        )
+        lines.append('')
+        lines.append(f"{'bytes':>12} source line")
+        for location, size in profile['lines']:
+            lines.append(f'{size:12d} {location}')
+        return lines
+
+
+class Tracer(Profiler):
+    """Profiler that also records every timed phase as a span in the Chrome trace event format.
+
+    A trace shows which phases of which documents ran concurrently, in which processes and
+    threads. Save it with :py:meth:`save`, and open it in https://ui.perfetto.dev or
+    chrome://tracing. The timestamps are ``time.perf_counter()`` values, in microseconds, which
+    are comparable between the processes on one machine, so that the traces of documents built
+    in parallel can be merged (see ``et-rstor build --trace``).
+    """
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+
+    def record(self, item_or_document, phase, seconds, start=None, **args):
+        super().record(item_or_document, phase, seconds, start, **args)
+        if start is None:
+            return
+        if isinstance(item_or_document, RstDocument):
+            name = f'{phase} {item_or_document.name}'
+            category = 'document'
+        else:
+            name = f'{phase} {item_or_document.__class__.__name__}'
+            category = 'item'
+            record = self.current.get(id(item_or_document))
+            args = dict(document=record['document'], location=record['location'], **args)
+        self.span(name, category, start, seconds, **args)
+
+
+    def span(self, name, category, start, seconds, **args):
+        """Add a span (a complete event) to the trace.
+
+        :param float start: the time.perf_counter() value at the start of the span.
+        :param float seconds: the duration of the span.
+        :param args: shown with the span in the trace viewer.
+        """
+        self.events.append({ 'name': name
+                           , 'cat': category
+                           , 'ph': 'X'
+                           , 'ts': 1e6*start
+                           , 'dur': 1e6*seconds
+                           , 'pid': os.getpid()
+                           , 'tid': getattr(threading, 'get_native_id', threading.get_ident)() # Python 3.8+
+                           , 'args': args
+                           })
+
+
+    def save(self, path):
+        """Save the trace as a JSON file in the Chrome trace event format."""
+        save_trace(path, self.events)
+
+
+def save_trace(path, events):
+    """Save a list of trace events as a JSON file in the Chrome trace event format."""
+    import json
+    Path(path).write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+
+####################################################################################################
+# Progress logging
+####################################################################################################
+# Levels of progress messages, see RstDocument.verbose. These are logging levels, but logging is
+# only imported when the first progress message is logged.
+SUMMARY = 20 # = logging.INFO: one line per document written
+ITEM = 15    # one line per RstItem rendered, with the time it took
+RST = 10     # = logging.DEBUG: the .rst of every RstItem, and every line executed
+
+_progress_listener = None
+_progress_lock = threading.Lock()
+
+
+def progress_logger():
+    """The logger ``et_rstor``, to which the progress messages of RstDocuments are logged.
+
+    If it has no handlers when a progress message is logged, :py:func:`start_progress_logging` is
+    called, so that progress is shown on stdout. To handle progress messages otherwise, configure
+    this logger before building documents, e.g. ``logging.getLogger('et_rstor').addHandler(h)``.
+    """
+    import logging
+    logger = logging.getLogger('et_rstor')
+    if not logger.handlers:
+        with _progress_lock:
+            if not logger.handlers:
+                _start_progress_listener(logger, None)
+    return logger
+
+
+def start_progress_logging(stream=None):
+    """Write the progress messages of RstDocuments to stream.
+
+    The messages are put on a queue, and written by a background thread, so that building a
+    document never waits for a slow terminal or file.
+
+    :param stream: a text stream, if None, the messages are written to ``sys.stdout`` as it is
+        when they are written.
+    """
+    import logging
+    with _progress_lock:
+        logger = logging.getLogger('et_rstor')
+        _stop_progress_listener(logger)
+        _start_progress_listener(logger, stream)
+
+
+def stop_progress_logging():
+    """Write the pending progress messages, and stop the thread of :py:func:`start_progress_logging`.
+
+    Logging a progress message afterwards starts it again, writing to ``sys.stdout``.
+    """
+    import logging
+    with _progress_lock:
+        _stop_progress_listener(logging.getLogger('et_rstor'))
+
+
+def _start_progress_listener(logger, stream):
+    import logging
+    import logging.handlers
+    import queue
+    import atexit
+
+    class StdoutHandler(logging.StreamHandler):
+        # ignores the stream set by the ctor of logging.StreamHandler
+        stream = property(lambda self: sys.stdout, lambda self, value: None)
+
+    global _progress_listener
+    logging.addLevelName(ITEM, 'ITEM')
+    handler = StdoutHandler() if stream is None else logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    q = queue.SimpleQueue()
+    _progress_listener = logging.handlers.QueueListener(q, handler)
+    _progress_listener.start()
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    logger.setLevel(RST)
+    logger.propagate = False
+    atexit.unregister(stop_progress_logging) # register only once
+    atexit.register(stop_progress_logging)
+
+
+def _stop_progress_listener(logger):
+    global _progress_listener
+    if _progress_listener is None:
+        return
+    _progress_listener.stop() # writes the pending messages
+    for handler in list(logger.handlers):
+        if getattr(handler, 'queue', None) is _progress_listener.queue:
+            logger.removeHandler(handler)
+    _progress_listener = None
+
+
 ####################################################################################################
 # Utilities
 ####################################################################################################
+def _to_json(obj):
+    """Encode the objects that json does not know, see :py:meth:`RstDocument.save`."""
+    if isinstance(obj, Path):
+        return {'__path__': str(obj)}
+    raise TypeError(f'Cannot save objects of type {type(obj)}.')
+
+
+def _from_json(d):
+    """Decode the objects encoded by :py:func:`_to_json`."""
+    if '__path__' in d:
+        return Path(d['__path__'])
+    return d
+
+
 def listify(obj,types=str):
     """If obj is a list verify that the type of its items are  in types. Otherwise verify that the
     type of obj is in types, and put obj in a list.
@@ -567,9 +2018,61 @@ class RemoveDir:
 
     def __call__(self):
         if self.pdir.is_dir():
+            import shutil
             shutil.rmtree(self.pdir)
 
 
+def file_digest(path):
+    """Compute the sha256 hex digest of the content of a file.
+
+    :param Path path: file to digest.
+    :return: the hex digest, or None if the file does not exist.
+    """
+    import hashlib
+    h = hashlib.sha256()
+    try:
+        with open(path, mode='rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.hexdigest()
+
+
+def write_if_changed(path, text):
+    """Write text to a file, unless the file already has exactly that content.
+
+    The text is first written to a temporary file in the same directory, which then atomically
+    replaces the destination, so that a reader never sees a half-written file. Unchanged files
+    keep their modification time, so that e.g. Sphinx does not need to re-read them.
+
+    :param Path path: destination file.
+    :param str text: content to write (utf-8 encoded).
+    :return: True if the file was changed, False otherwise.
+    """
+    import hashlib
+    path = Path(path)
+    data = text.encode('utf-8')
+    if file_digest(path) == hashlib.sha256(data).hexdigest():
+        return False
+    with open_temporary(path) as f:
+        f.write(data)
+    os.replace(f.name, path)
+    return True
+
+
+def open_temporary(path):
+    """Open a new temporary file for binary writing, next to path.
+
+    Unlike :py:mod:`tempfile`, the file is created with the default permissions (subject to the
+    umask), as it is meant to replace path.
+
+    :param Path path: file that the temporary file is meant to replace.
+    """
+    path = Path(path)
+    return path.with_name(f'.{path.name}.{os.urandom(6).hex()}.tmp').open(mode='xb')
+
+
 def package_name_of(project_name):
     """
     :param str project_name:
@@ -599,57 +2102,143 @@ class TextWrapper:
     * '*italics text*
     * '**bold face text**'
     * ``inline monospace``
-    * links: `text <url>`_
-    * things like :file:`may occasionally contain spaces`, are ignored for the time being.
+    * links: `text <url>`_, and other phrase references and interpreted text: `a phrase`_, `text`
+    * roles: :file:`may occasionally contain spaces`, :ref:`Some title <some-label>`
+    * substitutions: |some name|
+
+    Footnote and citation references ([#]_, [1]_, [CIT2002]_) and hyperlink references like Name_
+    cannot contain spaces, and are therefore always kept together.
 
     Note that these patterns may be followed with punctuation: . , : ; ... ? ! ) ] } ' "
+
+    A span ends at the first word after its opening word that matches its closing pattern, however
+    far away (as in reStructuredText, inline markup does not nest). The opening and closing words
+    of all patterns are found in a single scan of the text by one regular expression (see
+    :py:meth:`spans`), so wrapping takes time linear in the length of the text, also for text with
+    unmatched delimiters. The expression is only compiled when it is first needed.
     """
     patterns = \
-    ( ( re.compile(r"\A\*(\w+)")  , re.compile(r"(\w+)\*([,.:;!?\"\')}]?|(\.\.\.))\Z") )    # italics
-    , ( re.compile(r"\A\*\*(\w+)"), re.compile(r"(\w+)\*\*([,.:;!?\"\')}]?|(\.\.\.))\Z") )  # bold face
-    , ( re.compile(r"\A``(\w+)")  , re.compile(r"(\w+)``([,.:;!?\"\')}]?|(\.\.\.))\Z") )    # inline code sample
-    , ( re.compile(r"\A`(\w+)")                                                             # hyperlink
-      , re.compile(r"<(((http|https)\:\/\/)?[a-zA-Z0-9\.\/\?\:@\-_=#]+\.([a-zA-Z]){2,6}([a-zA-Z0-9\.\&\/\?\:@\-_=#])*)>`_([,.:;!?\"\')}]?|(\.\.\.))\Z") )
+    ( ( r"\*\w[^ *]*"         , r"\w+\*" )            # italics
+    , ( r"\*\*\w[^ *]*"       , r"\w+\*\*" )          # bold face
+    , ( r"``[^ `]+"           , r"[^ `]*[^ \\`]``" )  # inline code sample
+    , ( r"`[^ `]+"           , r"[^ `]+`(?:__?)?" )  # hyperlinks, phrase references, interpreted text
+    , ( r":[\w.:+-]+:`[^ `]*", r"[^ `]+`(?:__?)?" )  # roles
+    , ( r"\|[^ |]+"          , r"[^ |]+\|(?:__?)?" ) # substitutions
     )
+    """(opening, closing) regular expressions of the spans that are kept together. The opening
+    expression must match the first word of a span up to the first space, but not a word that
+    already contains the closing delimiter. The closing expression must match the whole of the last
+    word, except for trailing punctuation. Patterns may share a closing expression, but a word must
+    not match two different closing expressions. The expressions must not contain capturing groups.
+    """
+    punctuation = r"""(?:[,.:;!?"')}]?|\.\.\.)"""
+    delimiters = r"*`|"
+    """Characters of a regular expression character class, of which all opening and closing words
+    contain at least one. Other words are skipped without trying the patterns.
+    """
+
+    _compiled = {}
+    _digests = {}
+
+    @classmethod
+    def digest(cls):
+        """Digest of the rules for keeping words together: :py:attr:`patterns`,
+        :py:attr:`punctuation` and :py:attr:`delimiters`.
 
-    def __init__(self,width=72):
-        """"""
+        It is part of the :py:meth:`RstItem.fingerprint`, so that a :py:class:`RenderCache` does not
+        return text wrapped with other rules.
+        """
+        key = (cls.patterns, cls.punctuation, cls.delimiters)
+        digest = cls._digests.get(key)
+        if digest is None:
+            import hashlib
+            digest = cls._digests[key] = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:16]
+        return digest
+
+    @classmethod
+    def compiled_patterns(cls):
+        """The :py:attr:`patterns` compiled to find opening and closing words in a text.
+
+        :return: a regular expression matching the opening and closing words of all patterns, with
+            a group for each pattern, followed by a group for each distinct closing expression, and
+            a tuple with the closing group of each pattern's group.
+        """
+        key = (cls.patterns, cls.punctuation, cls.delimiters)
+        compiled = cls._compiled.get(key)
+        if compiled is None:
+            closings = list(dict.fromkeys(closing for _, closing in cls.patterns))
+            groups = [f'({opening})(?= )' for opening, _ in cls.patterns] \
+                   + [f'({closing}{cls.punctuation})(?= |\\Z)' for closing in closings]
+            compiled = cls._compiled[key] = \
+                ( re.compile(f'(?<![^ ])(?=[^ ]*[{cls.delimiters}])(?:{"|".join(groups)})')
+                , tuple(len(cls.patterns) + 1 + closings.index(closing) for _, closing in cls.patterns)
+                )
+        return compiled
+
+    def __init__(self, width=72, cache=None):
+        """
+        :param int width: the maximum width of the lines.
+        :param (WrapCache,bool) cache: cache of wrapped text. If None, the cache :py:data:`wrap_cache`,
+            shared by all TextWrappers, is used. If False, nothing is cached.
+        """
         self.width = width
-        self.lookahead = 15
+        self.cache = wrap_cache if cache is None else cache or None
+
+    def spans(self, text):
+        """The spans of :py:attr:`patterns` in text.
+
+        The opening and closing words are collected in one scan. An opening word starts a span
+        only if a matching closing word follows it, which is known from the position of the last
+        closing word of each kind, so that no word needs to be looked at twice.
+
+        :return: list of (start, end) offsets of the spans, in order.
+        """
+        regex, closing_group = self.compiled_patterns()
+        words = [(m.start(), m.end(), m.lastindex) for m in regex.finditer(text)]
+        last = {group: start for start, _, group in words} # closing group -> start of its last closing word
+        n_patterns = len(closing_group)
+        spans = []
+        closing = None # closing group of the current span
+        for start, end, group in words:
+            if closing is None:
+                if group <= n_patterns and last.get(closing_group[group - 1], -1) > start:
+                    closing = closing_group[group - 1]
+                    opening = start
+            elif group == closing:
+                spans.append((opening, end))
+                closing = None
+        return spans
+
+    def split(self, text):
+        """Split text in words at spaces, keeping the spans of :py:attr:`patterns` together."""
+        words = []
+        last = 0
+        for start, end in self.spans(text):
+            if start > last:
+                words.extend(text[last:start - 1].split(' ')) # without the space before the span
+            words.append(text[start:end])
+            last = end + 1 # skip the space after the span
+        if last <= len(text):
+            words.extend(text[last:].split(' '))
+        return words
 
     def wrap(self, text):
-        """"""
-        # split text in words
-        words = text.split(' ')
+        """Wrap text into lines.
+
+        :return: tuple of lines.
+        """
+        if self.cache is None:
+            return self._wrap(text)
+        key = (type(self), self.digest(), self.width, text)
+        lines = self.cache.get(key)
+        if lines is None:
+            lines = self._wrap(text)
+            self.cache.put(key, lines)
+        return lines
 
-        # join words that should not have been split
+    def _wrap(self, text):
+        words = self.split(text)
         n = len(words)
-        i = 0
-        while i < n:
-            word0 = words[i]
-            found = False
-            for p in TextWrapper.patterns:
-                if found:
-                    break
-                m0 = p[0].match(word0)
-                if m0:
-                    # begin of pattern found
-                    for j in range(1,self.lookahead+1):
-                        if i+j >= n:
-                            break
-                        word1 = words[i+j]
-                        m1 = p[1].match(word1)
-                        if m1:
-                            # end of pattern found, append all words to the wo
-                            words[i] = ' '.join(words[i:i+j+1])
-                            # pop the words that were appended to words[i]
-                            for k in range(j):
-                                words.pop(i+1)
-                                n -= 1
-                            found = True
-                            break
-            # print(words[i]) # for debugging
-            i += 1
 
         # build lines out of the words
         lines = []
@@ -658,24 +2247,79 @@ class TextWrapper:
         space_left = self.width
         while i < n:
             word_len = len(words[i])
-            if word_len > self.width: # a very long word
-                if i0 < i:
-                    lines.append(' '.join(words[i0:i]))
-                    lines.append(words[i])
-                    # print(lines[-2])
-                    # print(lines[-1])
-                    i0 = i+1
-                    space_left = self.width
-            else:
-                space_left -= word_len
-                if space_left < 0:
-                    lines.append(' '.join(words[i0:i]))
-                    # print(lines[-1])
-                    i0 = i
-                    space_left = self.width - word_len
+            if i0 < i:
+                word_len += 1 # the space before the word
+            space_left -= word_len
+            if space_left < 0 and i0 < i: # a word that is too long stays on a line of its own
+                lines.append(' '.join(words[i0:i]))
+                i0 = i
+                space_left = self.width - len(words[i])
             i += 1
         lines.append(' '.join(words[i0:]))
-        return lines
+        return tuple(lines)
+
+
+class WrapCache:
+    """Bounded cache of the lines of wrapped text, evicting the least recently used entries.
+
+    A WrapCache can be shared by the TextWrappers of many documents, as its keys comprise the class,
+    the :py:meth:`TextWrapper.digest` and the width of the TextWrapper, and end with the text. It is
+    thread safe.
+
+    :param int max_size: maximum total length of the cached texts, in characters.
+    """
+    def __init__(self, max_size=1024*1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = {} # in order of use, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """Return the lines cached for key, or None."""
+        with self.lock:
+            lines = self.entries.pop(key, None)
+            if lines is None:
+                self.misses += 1
+                return None
+            self.entries[key] = lines # most recently used
+            self.hits += 1
+            return lines
+
+
+    def put(self, key, lines):
+        """Store the lines for key, and evict least recently used entries if necessary."""
+        size = len(key[-1])
+        if size > self.max_size:
+            return
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.size -= size
+            self.entries[key] = lines
+            self.size += size
+            while self.size > self.max_size:
+                oldest = next(iter(self.entries))
+                del self.entries[oldest]
+                self.size -= len(oldest[-1])
+
+
+    def hit_rate(self):
+        """Fraction of :py:meth:`get` calls that found an entry."""
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+
+    def clear(self):
+        """Remove all entries, and reset the statistics."""
+        with self.lock:
+            self.entries.clear()
+            self.size = self.hits = self.misses = 0
+
+
+wrap_cache = WrapCache()
+"""The WrapCache shared by all TextWrappers, unless they are given another one."""
 
 
 @contextmanager
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+Module et_rstor.build
+=====================
+
+Building many RstDocuments in parallel.
+
+A *builder* is a function without arguments that builds and writes one RstDocument, like the
+``test_*`` functions that build the micc2 tutorials. Builders are discovered in Python modules and
+run in a pool of processes.
+
+Builders that must run in a particular order, e.g. because they build on the results of commands
+executed by other builders, declare so with the :py:func:`declare` decorator::
+
+    @declare(depends_on=['TutorialProject_et_dot_1'], workspace=project_path)
+    def test_TutorialProject_et_dot_2():
+        ...
+
+Builders sharing a workspace are run one after the other, in the order of discovery. Independent
+chains of builders run concurrently.
+
+A :py:class:`Watcher` rebuilds only the documents whose inputs changed.
+"""
+
+from pathlib import Path
+import importlib
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import redirect_stdout, redirect_stderr
+from fnmatch import fnmatch
+import os
+import re
+import sys
+import time
+import traceback
+
+from et_rstor import RstDocument, Tracer, stop_progress_logging
+
+
+def declare(depends_on=(), workspace=None):
+    """Decorator declaring the dependencies of a builder function.
+
+    The declarations must be known before the builder runs, which is why they are attached to the
+    builder function rather than to the RstDocument it creates.
+
+    :param list depends_on: names of the documents that must have been built successfully before
+        this one. Documents that are not part of the build are ignored.
+    :param (Path,str) workspace: the directory in which the builder executes its commands.
+        Builders with the same workspace are run in the order of discovery.
+    """
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    def decorate(f):
+        f.depends_on = tuple(depends_on)
+        f.workspace = workspace
+        return f
+    return decorate
+
+
+class Builder:
+    """A function that builds an RstDocument.
+
+    Builders are identified by the module they live in and their name, so that they can be
+    passed to worker processes.
+
+    :param str module: dotted module name, or path to a Python file.
+    :param str function: name of the builder function in module.
+    :param tuple depends_on: see :py:func:`declare`.
+    :param (Path,str) workspace: see :py:func:`declare`.
+    """
+    def __init__(self, module, function, depends_on=(), workspace=None):
+        self.module = module
+        self.function = function
+        self.depends_on = depends_on
+        self.workspace = workspace
+
+    @property
+    def name(self):
+        """Name of the document built, i.e. the function name without ``test_`` prefix."""
+        return self.function[5:] if self.function.startswith('test_') else self.function
+
+    def load(self):
+        """Return the builder function."""
+        return getattr(load_module(self.module), self.function)
+
+    def source(self):
+        """Path of the module file of the builder, or None."""
+        if self.module.endswith('.py') or os.sep in self.module:
+            return Path(self.module).resolve()
+        spec = importlib.util.find_spec(self.module)
+        return Path(spec.origin).resolve() if spec and spec.has_location else None
+
+    def __repr__(self):
+        return f'Builder({self.module!r}, {self.function!r})'
+
+
+class BuildResult:
+    """Outcome of running a Builder.
+
+    :param Builder builder: the builder that was run.
+    :param bool ok: True if the builder ran without raising an exception.
+    :param float elapsed: wall time of the builder, in seconds.
+    :param str error: the traceback if the builder failed, '' otherwise.
+    :param dict inputs: maps the files, and directory trees, read by the builder to True if they are
+        a directory tree, and to False otherwise.
+    :param list trace: the trace events of the builder, if it was traced (see :py:class:`Tracer`).
+    """
+    def __init__(self, builder, ok, elapsed, error='', inputs=None, trace=None):
+        self.builder = builder
+        self.ok = ok
+        self.elapsed = elapsed
+        self.error = error
+        self.inputs = inputs or {}
+        self.trace = trace or []
+
+    def __str__(self):
+        status = 'ok' if self.ok else 'FAILED'
+        s = f'{self.builder.name:<40} {status:<6} {self.elapsed:8.2f}s'
+        if not self.ok:
+            s += f'\n    {self.error.strip().splitlines()[-1]}'
+        return s
+
+
+def load_module(module):
+    """Import a module from a dotted module name or from a path to a Python file.
+
+    The directory of a Python file is put on sys.path, so that it can import its neighbours.
+    A module that was already imported is reloaded if its file was modified since.
+    """
+    if module.endswith('.py') or os.sep in module:
+        path = Path(module).resolve()
+        mtime = path.stat().st_mtime_ns
+        name = '_et_rstor_build' + re.sub(r'\W', '_', str(path.with_suffix('')))
+        m = sys.modules.get(name)
+        if m is not None and m.__et_rstor_mtime__ == mtime:
+            return m
+        if not str(path.parent) in sys.path:
+            sys.path.insert(0, str(path.parent))
+        spec = importlib.util.spec_from_file_location(name, path)
+        m = importlib.util.module_from_spec(spec)
+        m.__et_rstor_mtime__ = mtime
+        sys.modules[name] = m
+        spec.loader.exec_module(m)
+        return m
+
+    m = importlib.import_module(module)
+    if getattr(m, '__file__', None):
+        mtime = os.stat(m.__file__).st_mtime_ns
+        if getattr(m, '__et_rstor_mtime__', mtime) != mtime:
+            m = importlib.reload(m)
+        m.__et_rstor_mtime__ = mtime
+    return m
+
+
+def discover(modules, pattern='test_*'):
+    """Find the builder functions in modules.
+
+    :param list modules: dotted module names or paths to Python files.
+    :param str pattern: fnmatch pattern for the names of builder functions.
+    :return: list of Builders, in order of appearance.
+    """
+    builders = []
+    for module in modules:
+        m = load_module(module)
+        for name, obj in vars(m).items():
+            if callable(obj) and fnmatch(name, pattern) and getattr(obj, '__module__', None) == m.__name__:
+                builders.append(Builder( module, name
+                                       , depends_on=getattr(obj, 'depends_on', ())
+                                       , workspace=getattr(obj, 'workspace', None)
+                                       ))
+    return builders
+
+
+def dependencies(builders):
+    """Compute the dependencies of each builder on the other builders.
+
+    A builder depends on the builders it declared, and on the previous builder with the same
+    workspace.
+
+    :param list builders: the Builders to run, in order of discovery.
+    :return: dict mapping each builder name to the set of names of the builders it depends on.
+    :raises ValueError: if the dependencies contain a cycle.
+    """
+    names = {builder.name for builder in builders}
+    deps = {}
+    last_in_workspace = {}
+    for builder in builders:
+        deps[builder.name] = {name for name in builder.depends_on if name in names}
+        if builder.workspace is not None:
+            workspace = Path(builder.workspace).resolve()
+            if workspace in last_in_workspace:
+                deps[builder.name].add(last_in_workspace[workspace])
+            last_in_workspace[workspace] = builder.name
+
+    # verify that there are no cycles, by removing builders without pending dependencies.
+    pending = dict(deps)
+    while pending:
+        free = [name for name, d in pending.items() if not d & pending.keys()]
+        if not free:
+            raise ValueError(f'Cyclic dependencies between {sorted(pending)}.')
+        for name in free:
+            del pending[name]
+    return deps
+
+
+def run_builder(builder, log_dir=None, trace=False):
+    """Run a single builder, and time it.
+
+    The inputs of the builder are its module file and the inputs of the RstDocuments it creates
+    (see :py:meth:`RstDocument.add_input`).
+
+    :param Builder builder: the builder to run.
+    :param (Path,str) log_dir: if not None, the output of the builder is written to
+        ``<log_dir>/<name>.log``. Otherwise, it is discarded.
+    :param bool trace: if True, the builder and the RstDocuments it creates are traced with a
+        :py:class:`Tracer` (unless they have a profiler already).
+    :return: a BuildResult.
+    """
+    log = Path(log_dir) / f'{builder.name}.log' if log_dir else Path(os.devnull)
+    documents = []
+    tracer = Tracer() if trace else None
+
+    def observe(document):
+        documents.append(document)
+        if tracer is not None and document.profiler is None:
+            document.profiler = tracer
+
+    RstDocument.observers.append(observe)
+    t0 = time.perf_counter()
+    ok, error = True, ''
+    try:
+        with log.open(mode='w') as f, redirect_stdout(f), redirect_stderr(f):
+            try:
+                builder.load()()
+            except Exception:
+                ok, error = False, traceback.format_exc()
+                f.write(error)
+            finally:
+                stop_progress_logging() # write the pending progress messages to f
+    finally:
+        RstDocument.observers.remove(observe)
+    elapsed = time.perf_counter() - t0
+    if tracer is not None:
+        tracer.span(builder.name, 'builder', t0, elapsed, ok=ok)
+
+    inputs = {}
+    source = builder.source()
+    if source:
+        inputs[str(source)] = False
+    for document in documents:
+        for path, tree in document.input_paths().items():
+            inputs[str(path)] = inputs.get(str(path), False) or tree
+    return BuildResult(builder, ok, elapsed, error, inputs, tracer.events if tracer else None)
+
+
+def build(builders, jobs=None, log_dir=None, trace=False):
+    """Run builders in a pool of processes, respecting their dependencies.
+
+    A builder is started as soon as all builders it depends on have finished. If one of them
+    failed, the builder is skipped, and reported as failed.
+
+    :param list builders: the Builders to run, in order of discovery.
+    :param int jobs: number of worker processes, default is the number of CPUs. If 1, the builders
+        are run one after the other in the current process.
+    :param (Path,str) log_dir: see :py:func:`run_builder`.
+    :param bool trace: see :py:func:`run_builder`.
+    :return: generator yielding a BuildResult for every builder as soon as it finishes.
+    """
+    deps = dependencies(builders)
+    if log_dir:
+        Path(log_dir).mkdir(parents=True, exist_ok=True)
+
+    pending = list(builders)
+    ok = {} # builder name -> success
+
+    def start_ready(submit):
+        # Start the pending builders whose dependencies have finished, and return the results
+        # of those that must be skipped. Skipping a builder may make others ready, hence the loop.
+        skipped = []
+        progress = True
+        while progress:
+            progress = False
+            for builder in list(pending):
+                if not deps[builder.name] <= ok.keys():
+                    continue
+                pending.remove(builder)
+                progress = True
+                failed = sorted(name for name in deps[builder.name] if not ok[name])
+                if failed:
+                    ok[builder.name] = False
+                    skipped.append(BuildResult(builder, False, 0.0, f'Skipped because {failed} failed.'))
+                else:
+                    submit(builder)
+        return skipped
+
+    if jobs == 1:
+        ready = []
+        while pending:
+            yield from start_ready(ready.append)
+            while ready:
+                result = run_builder(ready.pop(0), log_dir, trace)
+                ok[result.builder.name] = result.ok
+                yield result
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        running = set()
+        submit = lambda builder: running.add(pool.submit(run_builder, builder, log_dir, trace))
+        yield from start_ready(submit)
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                ok[result.builder.name] = result.ok
+                yield result
+            yield from start_ready(submit)
+
+
+def signature(path, tree=False):
+    """Signature of the state of a file, or directory tree, that changes when it is modified.
+
+    :return: None if path does not exist.
+    """
+    try:
+        if not tree:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        entries = []
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                try:
+                    st = os.stat(os.path.join(root, file))
+                except OSError:
+                    continue
+                entries.append((root, file, st.st_mtime_ns, st.st_size))
+        if not entries and not os.path.isdir(path):
+            return None
+        return hash(tuple(sorted(entries)))
+    except OSError:
+        return None
+
+
+class Watcher:
+    """Rebuild the documents whose inputs changed.
+
+    Inputs are polled, because file system notifications are not portable without third party
+    packages. Changes made by the builders themselves, e.g. in their workspace, are absorbed by
+    taking a new snapshot of all inputs after every build.
+
+    :param list modules: dotted module names or paths to Python files containing builders.
+    :param str pattern: see :py:func:`discover`.
+    :param int jobs: see :py:func:`build`.
+    :param (Path,str) log_dir: see :py:func:`run_builder`.
+    """
+    def __init__(self, modules, pattern='test_*', jobs=None, log_dir=None):
+        self.modules = modules
+        self.pattern = pattern
+        self.jobs = jobs
+        self.log_dir = log_dir
+        self.builders = []
+        self.inputs = {}     # builder name -> {input path: is tree}
+        self.signatures = {} # (input path, is tree) -> signature
+
+
+    def build(self, names=None):
+        """Build the documents of the builders in names (default: all), and take a new snapshot.
+
+        :return: generator yielding a BuildResult for every builder as soon as it finishes.
+        """
+        try:
+            self.builders = discover(self.modules, pattern=self.pattern)
+        except Exception:
+            # e.g. a syntax error in a module being edited, keep the builders found before.
+            traceback.print_exc()
+        builders = [b for b in self.builders if names is None or b.name in names]
+        for result in build(builders, jobs=self.jobs, log_dir=self.log_dir):
+            self.inputs[result.builder.name] = result.inputs
+            yield result
+        self.signatures = {key: signature(*key) for inputs in self.inputs.values() for key in inputs.items()}
+
+
+    def poll(self):
+        """Compute the signatures of all inputs."""
+        return {key: signature(*key) for key in self.signatures}
+
+
+    def affected(self, changed):
+        """The names of the builders affected by the changed inputs.
+
+        These are the builders that read a changed input, and all builders that depend on them.
+        """
+        names = {name for name, inputs in self.inputs.items() if changed & inputs.keys()}
+        deps = dependencies(self.builders)
+        while True:
+            dependents = {name for name, d in deps.items() if d & names} - names
+            if not dependents:
+                return names
+            names |= dependents
+
+
+    def run(self, interval=0.5, debounce=0.2, report=print, rounds=None):
+        """Build all documents, then watch their inputs and rebuild the affected documents.
+
+        :param float interval: time between polls, in seconds.
+        :param float debounce: a rebuild only starts when the inputs did not change for this time,
+            in seconds, so that a burst of modifications triggers only one rebuild.
+        :param callable report: called with every BuildResult.
+        :param int rounds: stop after this number of rebuilds (default: never stop).
+        """
+        for result in self.build():
+            report(result)
+        while rounds is None or rounds > 0:
+            time.sleep(interval)
+            current = self.poll()
+            if current == self.signatures:
+                continue
+            while True:
+                time.sleep(debounce)
+                settled = self.poll()
+                if settled == current:
+                    break
+                current = settled
+            changed = {path for (path, tree), sig in current.items() if sig != self.signatures[(path, tree)]}
+            for result in self.build(self.affected(changed)):
+                report(result)
+            if rounds is not None:
+                rounds -= 1
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Command line interface et-rstor."""
+
+import argparse
+import sys
+import time
+
+from et_rstor import build, save_trace
+
+
+def cmd_build(args):
+    """Build the documents of all builder functions in args.modules."""
+    builders = build.discover(args.modules, pattern=args.pattern)
+    if not builders:
+        print(f'No builder functions matching {args.pattern!r} found.')
+        return 1
+    t0 = time.perf_counter()
+    failed = 0
+    trace = []
+    for result in build.build(builders, jobs=args.jobs, log_dir=args.log_dir, trace=bool(args.trace)):
+        print(result)
+        trace.extend(result.trace)
+        if not result.ok:
+            failed += 1
+    print(f'{len(builders)} documents built in {time.perf_counter() - t0:.2f}s, {failed} failed.')
+    if args.trace:
+        save_trace(args.trace, trace)
+        print(f'Trace written to {args.trace}.')
+    return 1 if failed else 0
+
+
+def cmd_watch(args):
+    """Build the documents of all builder functions in args.modules, and rebuild the documents
+    whose inputs change.
+    """
+    watcher = build.Watcher(args.modules, pattern=args.pattern, jobs=args.jobs, log_dir=args.log_dir)
+    try:
+        watcher.run(interval=args.interval, debounce=args.debounce)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv=None):
+    """Command line interface et-rstor."""
+    parser = argparse.ArgumentParser(prog='et-rstor', description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name, func, help in [ ('build', cmd_build, 'Build documents in parallel.')
+                            , ('watch', cmd_watch, 'Build documents, and rebuild them when their inputs change.')
+                            ]:
+        p = subparsers.add_parser(name, help=help)
+        p.add_argument('modules', nargs='+'
+                      , help='Python files or dotted module names containing document builder functions.'
+                      )
+        p.add_argument('-k', '--pattern', default='test_*'
+                      , help="fnmatch pattern for the names of builder functions (default: 'test_*')."
+                      )
+        p.add_argument('-j', '--jobs', type=int, default=None
+                      , help='Number of worker processes (default: number of CPUs).'
+                      )
+        p.add_argument('--log-dir', default=None
+                      , help='Directory for the output of each builder (default: discard output).'
+                      )
+        p.set_defaults(func=func)
+        if name == 'build':
+            p.add_argument('--trace', default=None, metavar='FILE'
+                          , help='Write a Chrome trace of the build to FILE, to be viewed in Perfetto.'
+                          )
+        if name == 'watch':
+            p.add_argument('--interval', type=float, default=0.5
+                          , help='Time between polls of the inputs, in seconds (default: 0.5).'
+                          )
+            p.add_argument('--debounce', type=float, default=0.2
+                          , help='Time the inputs must be unchanged before rebuilding, in seconds (default: 0.2).'
+                          )
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Module et_rstor.generator
+=========================
+
+Seeded generator of synthetic RstDocuments, for benchmarks and scaling tests.
+
+The documents can be made arbitrarily large, and contain a configurable mix of headings,
+paragraphs, notes, lists, tables and (not executed) code blocks. The text is sprinkled with
+inline markup (``**bold**``, ``*italic*``, ````literal````, hyperlinks and roles), often spanning
+several words, to stress the TextWrapper. The same seed always produces the same document::
+
+    from et_rstor.generator import generate
+    doc = generate(n_items=100000, seed=1, verbose=False)
+    doc.write()
+"""
+
+import random
+
+from et_rstor import RstDocument, Heading, Paragraph, Note, List, Table, CodeBlock
+
+default_mix = { 'Heading': 1
+              , 'Paragraph': 10
+              , 'Note': 1
+              , 'List': 2
+              , 'Table': 1
+              , 'CodeBlock': 2
+              }
+"""Default relative frequencies of the kinds of RstItems in a generated document."""
+
+vocabulary = ( 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+               'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+               'exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis aute irure '
+               'in reprehenderit voluptate velit esse cillum fugiat nulla pariatur excepteur sint '
+               'occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim id est '
+               'laborum project module function package build test documentation'
+             ).split()
+
+markups = ( ('**', '**')
+          , ('*', '*')
+          , ('``', '``')
+          , ('`', ' <https://example.com/{}>`_')
+          , (':file:`', '`')
+          , (':ref:`', '`')
+          )
+"""(opening, closing) delimiters of the inline markup used in generated text."""
+
+
+class Generator:
+    """Seeded generator of RstItems and RstDocuments.
+
+    :param int seed: seed of the random number generator.
+    :param float markup: probability that a word starts an inline markup span.
+    :param tuple span_words: (min, max) number of words in an inline markup span.
+    :param tuple paragraph_words: (min, max) number of words in a paragraph.
+    """
+    def __init__(self, seed=0, markup=0.1, span_words=(1, 5), paragraph_words=(20, 200)):
+        self.random = random.Random(seed)
+        self.markup = markup
+        self.span_words = span_words
+        self.paragraph_words = paragraph_words
+
+
+    def words(self, n):
+        """List of n random words."""
+        return self.random.choices(vocabulary, k=n)
+
+
+    def text(self, n_words):
+        """Text of about n_words words, with inline markup spans and sentences."""
+        rng = self.random
+        words = []
+        while len(words) < n_words:
+            if rng.random() < self.markup:
+                opening, closing = rng.choice(markups)
+                span = self.words(rng.randint(*self.span_words))
+                words.append(opening + ' '.join(span) + closing.format(span[0]))
+            else:
+                words.append(rng.choice(vocabulary))
+            if rng.random() < 0.1:
+                words[-1] += '.'
+        text = ' '.join(words)
+        return text if text.endswith('.') else text + '.'
+
+
+    def item(self, kind, document):
+        """Create an RstItem of kind (a class name, see :py:data:`default_mix`) in document."""
+        return getattr(self, kind.lower())(document)
+
+
+    def heading(self, document):
+        level = self.random.choice((2, 3, 3, 4))
+        return Heading(' '.join(self.words(self.random.randint(2, 6))).capitalize(), level=level, document=document)
+
+
+    def paragraph(self, document):
+        return Paragraph(self.text(self.random.randint(*self.paragraph_words)), document=document)
+
+
+    def note(self, document):
+        return Note([self.text(self.random.randint(10, 60)) for _ in range(self.random.randint(1, 3))], document=document)
+
+
+    def list(self, document):
+        items = [self.text(self.random.randint(3, 30)) for _ in range(self.random.randint(2, 8))]
+        return List(items, numbered=self.random.random() < 0.3, document=document)
+
+
+    def table(self, document):
+        ncols = self.random.randint(2, 5)
+        rows = [self.words(ncols)]
+        for _ in range(self.random.randint(2, 20)):
+            rows.append([self.random.choice((self.random.randint(0, 10**6), ' '.join(self.words(3))))
+                         for _ in range(ncols)])
+        return Table(rows, document=document)
+
+
+    def codeblock(self, document):
+        if self.random.random() < 0.5:
+            lines = [f'{" ".join(self.words(2)).replace(" ", "_")} = {self.random.randint(0, 999)}'
+                     for _ in range(self.random.randint(1, 10))]
+            return CodeBlock(lines, language='python', document=document)
+        lines = [f'{self.random.choice(("ls", "cd", "micc2", "git"))} {" ".join(self.words(2))}'
+                 for _ in range(self.random.randint(1, 5))]
+        return CodeBlock(lines, language='bash', document=document)
+
+
+    def document(self, name='generated', n_items=1000, mix=None, **kwargs):
+        """Create an RstDocument of n_items RstItems.
+
+        :param str name: name of the document.
+        :param int n_items: number of RstItems.
+        :param dict mix: relative frequencies of the kinds of RstItems, default :py:data:`default_mix`.
+        :param kwargs: parameters for the RstDocument ctor.
+        """
+        mix = mix or default_mix
+        kinds = self.random.choices(list(mix), weights=list(mix.values()), k=n_items)
+        document = RstDocument(name, **kwargs)
+        for kind in kinds:
+            self.item(kind, document)
+        return document
+
+
+def generate(n_items=1000, seed=0, mix=None, name='generated', **kwargs):
+    """Create an RstDocument of n_items random RstItems, see :py:meth:`Generator.document`."""
+    return Generator(seed).document(name, n_items, mix, **kwargs)
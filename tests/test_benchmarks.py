@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the rendering hot paths.
+
+The benchmarks are not run by default. Run them with::
+
+    > pytest -m benchmark tests/test_benchmarks.py -s
+
+Every benchmark is compared to its baseline in ``tests/benchmarks.json``, and fails if it is more
+than a threshold (default 1.5, i.e. 50%) slower. To make the baselines comparable between
+machines, all timings are divided by the time of a fixed pure Python workload (see
+:py:func:`calibration`).
+
+Benchmarks of a large document, dominated by memory access, and of pycon CodeBlocks, dominated by
+starting a Python process, vary more between runs than the calibration, and have a wider threshold.
+
+The threshold of all benchmarks can be overridden with the environment variable
+ET_RSTOR_BENCHMARK_THRESHOLD. If the environment variable ET_RSTOR_UPDATE_BENCHMARKS is set, the
+baselines are replaced by the timings measured, so that the changes show up in review.
+"""
+
+import sys
+if not '.' in sys.path:
+    sys.path.insert(0, '.')
+import json
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+from et_rstor import *
+from et_rstor.generator import Generator
+
+pytestmark = pytest.mark.benchmark
+
+baselines_path = Path(__file__).parent / 'benchmarks.json'
+threshold = float(os.environ.get('ET_RSTOR_BENCHMARK_THRESHOLD', 1.5))
+threshold_overridden = 'ET_RSTOR_BENCHMARK_THRESHOLD' in os.environ
+update = bool(os.environ.get('ET_RSTOR_UPDATE_BENCHMARKS'))
+
+def best_of(func, repeat):
+    """Best wall time of repeat calls of func, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+_calibration = []
+
+def calibration():
+    """Time of a fixed pure Python workload (string building and list manipulation) on this machine."""
+    words = 'lorem ipsum dolor sit amet'.split()
+    def workload():
+        lines = []
+        for i in range(200000):
+            lines.append(f'{i:6d} {words[i % len(words)]}')
+        return ' '.join(lines).split(' ')
+    if not _calibration:
+        _calibration.append(best_of(workload, 5))
+    return _calibration[0]
+
+
+def check(name, func, repeat=5, threshold=threshold):
+    """Time func, and compare to the baseline of benchmark name.
+
+    :param float threshold: the factor by which benchmark name may be slower than its baseline,
+        unless ET_RSTOR_BENCHMARK_THRESHOLD is set.
+    """
+    if threshold_overridden:
+        threshold = globals()['threshold']
+    relative = best_of(func, repeat) / calibration()
+    baselines = json.loads(baselines_path.read_text()) if baselines_path.exists() else {}
+    baseline = baselines.get(name)
+    print(f'\n{name}: {relative:.3f} (baseline {baseline}, threshold {threshold})')
+    if update or baseline is None:
+        baselines[name] = round(relative, 3)
+        baselines_path.write_text(json.dumps(baselines, indent=1, sort_keys=True) + '\n')
+    else:
+        assert relative < threshold * baseline, f'{name} is {relative / baseline:.2f} times slower than its baseline.'
+
+
+def test_wrap_long_paragraph():
+    paragraph = Generator(seed=1).text(20000) # about 150kB
+    wrapper = TextWrapper(width=72, cache=False)
+    check('wrap_long_paragraph', lambda: wrapper.wrap(paragraph), repeat=3)
+
+
+def test_wrap_many_paragraphs():
+    generator = Generator(seed=2)
+    paragraphs = [generator.text(80) for i in range(1000)]
+    wrapper = TextWrapper(width=72, cache=False)
+    check('wrap_many_paragraphs', lambda: [wrapper.wrap(p) for p in paragraphs])
+
+
+def test_wrap_repeated_paragraphs():
+    generator = Generator(seed=6)
+    paragraphs = 10*[generator.text(80) for i in range(100)]
+    wrapper = TextWrapper(width=72, cache=WrapCache())
+    check('wrap_repeated_paragraphs', lambda: [wrapper.wrap(p) for p in paragraphs])
+
+
+def test_wrap_stray_delimiters():
+    words = Generator(seed=5).text(20000).split(' ')
+    for i in range(0, len(words), 10):
+        words[i] = '**' + words[i] # unclosed bold face
+    paragraph = ' '.join(words)
+    wrapper = TextWrapper(width=72, cache=False)
+    check('wrap_stray_delimiters', lambda: wrapper.wrap(paragraph), repeat=3)
+
+
+def test_table_10k_rows():
+    generator = Generator(seed=3)
+    rows = [['name', 'value', 'description']] + [[f'item {i}', i*i, generator.text(5)] for i in range(10000)]
+    check('table_10k_rows', lambda: Table(rows, document=None))
+
+
+def test_document_100k_items():
+    doc = Generator(seed=4, paragraph_words=(10, 40)).document('benchmark', 100000, verbose=False, lazy=True)
+    doc.set_textwrapper(TextWrapper(doc.width, cache=False))
+    def render():
+        for item in doc.items:
+            item.rst = None
+        doc.render()
+    check('document_100k_items', render, repeat=2, threshold=2.0)
+    check('document_100k_items_rstor', doc.rstor, threshold=2.0)
+
+
+def test_bash_command_overhead(tmp_path):
+    doc = RstDocument('benchmark', verbose=False)
+    lines = 20*['true']
+    check( 'bash_command_overhead'
+         , lambda: CodeBlock(lines, language='bash', execute=True, cwd=tmp_path, document=doc)
+         )
+
+
+def test_pycon_command_overhead(tmp_path):
+    doc = RstDocument('benchmark', verbose=False)
+    lines = [f'x = {i}' for i in range(1000)]
+    check( 'pycon_command_overhead'
+         , lambda: CodeBlock(lines, language='pycon', execute=True, cwd=tmp_path, document=doc)
+         , threshold=2.0
+         )
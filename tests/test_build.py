@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for building multiple documents with et_rstor.build and the et-rstor CLI."""
+
+import sys
+if not '.' in sys.path:
+    sys.path.insert(0, '.')
+
+from et_rstor import build
+from et_rstor.cli_et_rstor import main
+
+builders_py = '''
+from pathlib import Path
+from et_rstor import *
+
+out = Path(__file__).parent
+
+def test_One():
+    doc = RstDocument('One', verbose=False)
+    Paragraph('one', document=doc)
+    doc.write(out)
+
+def test_Two():
+    doc = RstDocument('Two', verbose=False)
+    Paragraph('two', document=doc)
+    doc.write(out)
+
+def test_Broken():
+    raise ValueError('broken')
+
+def helper():
+    pass
+'''
+
+
+def test_build(tmp_path):
+    module = tmp_path / 'builders.py'
+    module.write_text(builders_py)
+    builders = build.discover([str(module)])
+    assert [b.name for b in builders] == ['One', 'Two', 'Broken']
+
+    results = {r.builder.name: r for r in build.build(builders, jobs=2, log_dir=tmp_path / 'logs')}
+    assert results['One'].ok and results['Two'].ok
+    assert not results['Broken'].ok
+    assert 'ValueError: broken' in results['Broken'].error
+    assert (tmp_path / 'One.rst').read_text() == 'one\n\n'
+    assert 'ValueError: broken' in (tmp_path / 'logs' / 'Broken.log').read_text()
+
+
+def test_cli_build(tmp_path, capsys):
+    module = tmp_path / 'builders.py'
+    module.write_text(builders_py)
+    assert main(['build', str(module), '-k', 'test_T*', '-j', '1']) == 0
+    assert '1 documents built' in capsys.readouterr().out
+    assert (tmp_path / 'Two.rst').exists()
+
+
+def test_cli_build_trace(tmp_path, capsys):
+    import json
+    module = tmp_path / 'builders.py'
+    module.write_text(builders_py)
+    trace = tmp_path / 'trace.json'
+    assert main(['build', str(module), '-k', 'test_[OT]*', '-j', '2', '--trace', str(trace)]) == 0
+    events = json.loads(trace.read_text())['traceEvents']
+    names = {event['name'] for event in events}
+    assert {'One', 'Two', 'build One', 'write Two', 'render Paragraph'} <= names
+    for event in events:
+        assert event['ph'] == 'X' and event['dur'] >= 0
+        assert {'ts', 'pid', 'tid', 'cat', 'args'} <= event.keys()
+    builder = next(event for event in events if event['name'] == 'One')
+    render = next(event for event in events if event['name'] == 'render Paragraph'
+                                              and event['args']['document'] == 'One')
+    assert render['pid'] == builder['pid']
+    assert builder['ts'] <= render['ts'] <= builder['ts'] + builder['dur']
+
+
+def test_tracer_without_native_id(tmp_path, monkeypatch):
+    # threading.get_native_id() is not available before Python 3.8
+    import threading
+    from et_rstor import RstDocument, Paragraph, Tracer
+    monkeypatch.delattr(threading, 'get_native_id', raising=False)
+    tracer = Tracer()
+    doc = RstDocument('traced', verbose=False, profiler=tracer)
+    Paragraph('one', document=doc)
+    doc.write(tmp_path)
+    assert tracer.events and all(event['tid'] == threading.get_ident() for event in tracer.events)
+
+
+chained_py = '''
+import time
+from pathlib import Path
+from et_rstor.build import declare
+
+log = Path(__file__).parent / 'order.txt'
+workspace = Path(__file__).parent / 'ws'
+
+@declare(workspace=workspace)
+def test_First():
+    time.sleep(0.2)
+    with log.open('a') as f: f.write('First ')
+
+@declare(workspace=workspace)
+def test_Second():
+    with log.open('a') as f: f.write('Second ')
+
+def test_Broken():
+    raise ValueError('broken')
+
+@declare(depends_on='Broken')
+def test_Dependent():
+    with log.open('a') as f: f.write('Dependent ')
+'''
+
+
+def test_build_dependencies(tmp_path):
+    module = tmp_path / 'chained.py'
+    module.write_text(chained_py)
+    builders = build.discover([str(module)])
+    assert build.dependencies(builders) == { 'First': set(), 'Second': {'First'}
+                                           , 'Broken': set(), 'Dependent': {'Broken'}
+                                           }
+    for jobs in (1, 3):
+        results = {r.builder.name: r for r in build.build(builders, jobs=jobs)}
+        assert [name for name, r in results.items() if r.ok] == ['First', 'Second']
+        assert 'Skipped' in results['Dependent'].error
+        assert (tmp_path / 'order.txt').read_text() == 'First Second '
+        (tmp_path / 'order.txt').unlink()
+
+
+def test_build_cyclic_dependencies():
+    builders = [ build.Builder('m', 'test_A', depends_on=('B',))
+               , build.Builder('m', 'test_B', depends_on=('A',))
+               ]
+    try:
+        build.dependencies(builders)
+    except ValueError as e:
+        assert 'Cyclic' in str(e)
+    else:
+        assert False
+
+
+watched_py = '''
+from pathlib import Path
+from et_rstor import *
+
+here = Path(__file__).parent
+
+def test_Copied():
+    doc = RstDocument('Copied', verbose=False)
+    CodeBlock(copyfrom=here / 'snippet.py', language='python', document=doc)
+    doc.write(here)
+
+def test_Included():
+    doc = RstDocument('Included', verbose=False)
+    Include('included.rst', document=doc)
+    doc.write(here)
+'''
+
+
+def test_watcher(tmp_path):
+    module = tmp_path / 'watched.py'
+    module.write_text(watched_py)
+    (tmp_path / 'snippet.py').write_text('a = 1\n')
+    (tmp_path / 'included.rst').write_text('Included.\n')
+
+    watcher = build.Watcher([str(module)], jobs=1)
+    assert all(r.ok for r in watcher.build())
+    assert str(tmp_path / 'snippet.py') in watcher.inputs['Copied']
+    assert str(tmp_path / 'included.rst') in watcher.inputs['Included']
+    assert watcher.poll() == watcher.signatures
+
+    (tmp_path / 'snippet.py').write_text('a = 2\n')
+    changed = {path for (path, tree), sig in watcher.poll().items() if sig != watcher.signatures[(path, tree)]}
+    assert watcher.affected(changed) == {'Copied'}
+    assert [r.builder.name for r in watcher.build({'Copied'})] == ['Copied']
+    assert 'a = 2' in (tmp_path / 'Copied.rst').read_text()
+    assert watcher.poll() == watcher.signatures
@@ -0,0 +1,563 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for RstDocument features that do not build a tutorial."""
+
+import sys
+if not '.' in sys.path:
+    sys.path.insert(0, '.')
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import os
+
+import pytest
+
+from et_rstor import *
+
+
+def build_small(document):
+    Heading('A small document', level=2, crosslink='small', document=document)
+    Paragraph('Some text with **bold face** and ``code``.', document=document)
+    List(['one', 'two'], document=document)
+    Table([['a', 'b'], [1, 2]], document=document)
+    CodeBlock(['print(1)'], language='python', document=document)
+
+
+def test_stream_to(tmp_path):
+    (tmp_path / 'stored').mkdir()
+    doc = RstDocument('small', verbose=False)
+    build_small(doc)
+    doc.write(tmp_path / 'stored')
+
+    streamed = RstDocument('small', verbose=False, stream_to=tmp_path)
+    build_small(streamed)
+    assert not streamed.items
+    streamed.write()
+
+    assert (tmp_path / 'small.rst').read_text() == (tmp_path / 'stored' / 'small.rst').read_text()
+
+
+def test_lazy(tmp_path):
+    doc = RstDocument('lazy', verbose=False, lazy=True)
+    Paragraph('Touching a file:', document=doc)
+    CodeBlock('touch touched', language='bash', execute=True, cwd=tmp_path, document=doc)
+    Paragraph('Not needed.', document=doc)
+    assert all(item.rst is None for item in doc.items)
+    assert not (tmp_path / 'touched').exists()
+
+    doc.items = [item for item in doc.items if not isinstance(item, Paragraph) or 'Not' not in item.text]
+    doc.render()
+    assert (tmp_path / 'touched').exists()
+    assert 'touch touched' in doc.rst
+    assert 'Not needed' not in doc.rst
+
+
+def test_lazy_heading_numbers():
+    doc = RstDocument('lazy', verbose=False, lazy=True, headings_numbered_from_level=2)
+    for title in ('One', 'Two', 'Three'):
+        Heading(title, level=2, document=doc)
+        Heading(f'{title} a', level=3, document=doc)
+    doc.items = [item for item in doc.items if not item.text.startswith('Two')]
+    doc.render()
+    assert [item.heading for item in doc.items] == ['1. One', '1.1. One a', '2. Three', '2.1. Three a']
+    doc.items = doc.items[2:] + doc.items[:2]
+    doc.render()
+    assert [item.heading for item in doc.items] == ['1. Three', '1.1. Three a', '2. One', '2.1. One a']
+    assert '2. One\n' in doc.rst and '2. Three' not in doc.rst
+
+
+def test_lazy_heading_numbers_preset(tmp_path):
+    docs = []
+    for lazy in (False, True):
+        doc = RstDocument('preset', verbose=False, lazy=lazy, headings_numbered_from_level=2)
+        doc.heading_numbers[2] = 3
+        Heading('Fourth tutorial', level=2, document=doc)
+        Heading('First section', level=3, document=doc)
+        doc.render()
+        docs.append(doc)
+    assert docs[0].rst == docs[1].rst
+    assert '4. Fourth tutorial' in docs[1].rst and '4.1. First section' in docs[1].rst
+    docs[0].save(tmp_path / 'preset.json')
+    loaded = RstDocument.load(tmp_path / 'preset.json', lazy=True)
+    loaded.render()
+    assert loaded.rst == docs[0].rst
+
+
+class OldStyleItem(RstItem):
+    """An RstItem written for et_rstor 1.2.0, which calls self.rstor() instead of self.finish()."""
+    def __init__(self, text, document=None):
+        super().__init__(document=document)
+        self.text = text
+        self.rstor()
+        self.show_progress()
+
+    def rstor(self):
+        self.rst = f'{self.text}\n\n'
+
+
+def test_old_style_item(tmp_path):
+    import io
+    stream = io.StringIO()
+    start_progress_logging(stream)
+    try:
+        doc = RstDocument('old', verbose=RST)
+        Paragraph('first', document=doc)
+        OldStyleItem('second', document=doc)
+        Paragraph('third', document=doc)
+        with pytest.warns(FutureWarning, match='OldStyleItem'):
+            doc.write(tmp_path)
+    finally:
+        stop_progress_logging()
+    assert doc.rst == 'first\n\nsecond\n\nthird\n\n'
+    assert not doc.unfinished
+    assert 'rstor> OldStyleItem\n$$$$$$\nsecond\n' in stream.getvalue()
+
+
+def test_write_if_changed(tmp_path):
+    doc = RstDocument('small', verbose=False)
+    build_small(doc)
+    assert doc.write(tmp_path)
+    p = tmp_path / 'small.rst'
+    mtime = p.stat().st_mtime_ns
+    assert not doc.write(tmp_path)
+    assert p.stat().st_mtime_ns == mtime
+
+    Paragraph('One more paragraph.', document=doc)
+    assert doc.write(tmp_path)
+    assert p.read_text().endswith('One more paragraph.\n\n')
+    assert list(tmp_path.iterdir()) == [p]
+
+    streamed = RstDocument('small', verbose=False, stream_to=tmp_path)
+    build_small(streamed)
+    Paragraph('One more paragraph.', document=streamed)
+    assert not streamed.write()
+    assert list(tmp_path.iterdir()) == [p]
+
+
+def test_render_cache(tmp_path):
+    with RenderCache(tmp_path / 'cache.sqlite') as cache:
+        doc = RstDocument('small', verbose=False, cache=cache)
+        build_small(doc)
+        assert (cache.hits, cache.misses) == (0, 5)
+        doc.write(tmp_path)
+
+    with RenderCache(tmp_path / 'cache.sqlite') as cache:
+        doc = RstDocument('small', verbose=False, cache=cache)
+        build_small(doc)
+        assert (cache.hits, cache.misses) == (5, 0)
+        assert not doc.write(tmp_path)
+
+        doc = RstDocument('small', verbose=False, width=40, cache=cache)
+        build_small(doc)
+        assert cache.misses == 5
+
+
+class Callout(RstItem):
+    """An RstItem that does not list its source_fields."""
+    def __init__(self, text, document=None):
+        super().__init__(document=document)
+        self.text = text
+        self.finish()
+
+    def rstor(self):
+        self.rst = f'.. callout:: {self.text}\n\n'
+
+
+def test_render_cache_source_fields(tmp_path):
+    with RenderCache(tmp_path / 'cache.sqlite') as cache:
+        doc = RstDocument('callouts', verbose=False, cache=cache)
+        first, second = Callout('first', document=doc), Callout('second', document=doc)
+        assert not first.is_cacheable()
+        assert second.rst == '.. callout:: second\n\n'
+        assert (cache.hits, cache.misses) == (0, 0)
+
+    def subclass(base):
+        class Paragraph(base): # same name, other module and qualname
+            __slots__ = ()
+        return Paragraph
+    doc = RstDocument('digests', verbose=False)
+    assert Paragraph('x', document=doc).source_digest() != subclass(Paragraph)('x', document=doc).source_digest()
+
+
+def test_render_cache_lazy_and_threads(tmp_path):
+    import sqlite3
+    cache = RenderCache(tmp_path / 'cache.sqlite')
+    try:
+        doc = RstDocument('lazy', verbose=False, lazy=True, cache=cache)
+        build_small(doc)
+        doc.write(tmp_path)
+        # committed, i.e. visible to another connection
+        assert sqlite3.connect(str(tmp_path / 'cache.sqlite')).execute('SELECT COUNT(*) FROM items').fetchone()[0] == 5
+
+        def build(i):
+            doc = RstDocument(f'doc{i}', verbose=False, width=40 + i % 4, cache=cache)
+            build_small(doc)
+            doc.write(tmp_path)
+            return doc.rst
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(build, range(32)))
+        assert all(rst == results[i % 4] for i, rst in enumerate(results))
+        assert cache.hits + cache.misses == 5*33 and cache.hits >= 5*(32 - 8)
+    finally:
+        cache.close()
+
+
+def test_render_cache_shared(tmp_path):
+    # connections of different processes, each building a document
+    one = RenderCache(tmp_path / 'cache.sqlite', timeout=0.5)
+    two = RenderCache(tmp_path / 'cache.sqlite', timeout=0.5)
+    try:
+        one.put('a', 'A')
+        assert one.get('a') == 'A'
+        two.put('b', 'B')
+        two.commit()
+        assert two.get('b') == 'B' and one.get('b') == 'B'
+        one.commit()
+        assert two.get('a') == 'A'
+        two.commit()
+    finally:
+        one.close()
+        two.close()
+
+
+def test_render_cache_eviction(tmp_path):
+    with RenderCache(tmp_path / 'cache.sqlite', max_size=25) as cache:
+        for key in 'abc':
+            cache.put(key, 10*key)
+        assert cache.get('a') is None
+        assert cache.get('b') == 10*'b'
+        cache.put('d', 10*'d')
+        assert cache.get('c') is None
+        assert cache.get('b') == 10*'b'
+        assert cache.size == 20
+
+
+def test_split_level(tmp_path):
+    doc = RstDocument('split', verbose=False, split_level=3)
+    Include('../HYPERLINKS.rst', document=doc)
+    Heading('Top', level=2, crosslink='top', document=doc)
+    Paragraph('Introduction.', document=doc)
+    for i in range(3):
+        Heading(f'Part {i}', level=3, crosslink=f'part-{i}', document=doc)
+        Paragraph(f'See :ref:`part-{(i+1)%3}`.', document=doc)
+        Heading(f'Section {i}', level=4, document=doc)
+    doc.write(tmp_path)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['split-001.rst', 'split-002.rst', 'split-003.rst', 'split.rst']
+    parent = (tmp_path / 'split.rst').read_text()
+    assert parent.startswith('.. include:: ../HYPERLINKS.rst')
+    assert 'Introduction.' in parent
+    assert parent.endswith('.. toctree::\n\n   split-001\n   split-002\n   split-003\n\n')
+    part = (tmp_path / 'split-002.rst').read_text()
+    assert part.startswith('.. include:: ../HYPERLINKS.rst\n\n.. _part-1:\n\nPart 1\n')
+    assert 'Section 1' in part
+
+    doc.items = doc.items[:-3]
+    assert doc.write(tmp_path)
+    assert not (tmp_path / 'split-003.rst').exists()
+
+    with pytest.raises(ValueError):
+        RstDocument('split', verbose=False, split_level=2, stream_to=tmp_path)
+
+
+def test_default_document_per_thread():
+    barrier = threading.Barrier(2)
+    def build(name):
+        doc = RstDocument(name, verbose=False, is_default_document=True)
+        for i in range(100):
+            Paragraph(name)
+            if i == 0:
+                barrier.wait()
+        return doc
+    with ThreadPoolExecutor(2) as pool:
+        docs = list(pool.map(build, ['one', 'two']))
+    for doc in docs:
+        assert len(doc.items) == 100
+        assert all(item.text == doc.name for item in doc.items)
+
+
+def test_as_default():
+    outer = RstDocument('outer', verbose=False)
+    inner = RstDocument('inner', verbose=False)
+    with outer.as_default():
+        Paragraph('outer')
+        with inner.as_default():
+            Paragraph('inner')
+        Paragraph('outer')
+    assert [item.text for item in outer.items] == ['outer', 'outer']
+    assert [item.text for item in inner.items] == ['inner']
+
+
+def test_execute_in_threads(tmp_path):
+    for name in ('one', 'two'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / f'module_{name}.py').write_text(f'name = {name!r}\n')
+    sys_path = list(sys.path)
+    cwd = os.getcwd()
+
+    def build(name):
+        doc = RstDocument(name, verbose=False)
+        for i in range(20):
+            CodeBlock('ls', language='bash', execute=True, cwd=tmp_path / name, document=doc)
+            CodeBlock( [f'import module_{name}', f'print(module_{name}.name * {i})']
+                     , language='pycon', execute=True, cwd=tmp_path / name, document=doc
+                     )
+        doc.render()
+        return doc
+
+    with ThreadPoolExecutor(2) as pool:
+        docs = list(pool.map(build, ['one', 'two']))
+    for doc, other in zip(docs, reversed(docs)):
+        assert f'module_{doc.name}.py' in doc.rst
+        assert 19*doc.name in doc.rst
+        assert other.name not in doc.rst.replace(f'module_{doc.name}', '')
+    assert sys.path == sys_path
+    assert os.getcwd() == cwd
+
+
+def test_execute_same_module_in_threads(tmp_path):
+    for name in ('one', 'two'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'workspace.py').write_text(f'name = {name!r}\n')
+        (tmp_path / name / 'data.txt').write_text(f'{name} data\n')
+
+    def build(name):
+        doc = RstDocument(name, verbose=False)
+        for i in range(20):
+            CodeBlock( ['import workspace', 'print(workspace.name)', 'print(open("data.txt").read())']
+                     , language='pycon', execute=True, cwd=tmp_path / name, document=doc
+                     )
+        doc.render()
+        return doc
+
+    with ThreadPoolExecutor(2) as pool:
+        docs = list(pool.map(build, ['one', 'two']))
+    for doc, other in zip(docs, reversed(docs)):
+        assert doc.rst.count(f'    {doc.name}\n') == 20
+        assert doc.rst.count(f'{doc.name} data') == 20
+        assert other.name not in doc.rst
+    assert 'workspace' not in sys.modules
+
+
+def test_execute_relative_paths_in_threads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'ws').mkdir()
+    cwd = os.getcwd()
+
+    def pycon():
+        doc = RstDocument('pycon', verbose=False)
+        for i in range(10):
+            CodeBlock( ['import os', 'print(os.getcwd())'], language='pycon', execute=True
+                     , cwd='ws', document=doc
+                     )
+        return doc
+
+    def write():
+        for i in range(200):
+            with open(f'out{i}.txt', 'w') as f:
+                f.write(os.getcwd())
+
+    with ThreadPoolExecutor(2) as pool:
+        doc = pool.submit(pycon)
+        pool.submit(write).result()
+        doc = doc.result()
+    doc.render()
+    assert doc.rst.count(str(tmp_path.resolve() / 'ws')) == 10
+    assert all((tmp_path / f'out{i}.txt').read_text() == cwd for i in range(200))
+    assert os.getcwd() == cwd
+
+
+def test_execute_pycon_errors(tmp_path):
+    doc = RstDocument('errors', verbose=False)
+    block = CodeBlock( ['1/0', 'print("next")'], language='pycon', execute=True, error_ok=True
+                     , cwd=tmp_path, document=doc
+                     )
+    assert 'ZeroDivisionError' in block.outputs[0][0]
+    assert 'exec(' not in block.outputs[0][0] # only the frames of the statement
+    assert block.outputs[1][0] == 'next\n'
+    with pytest.raises(RuntimeError, match="Statement '1/0' failed"):
+        CodeBlock(['1/0', 'print("next")'], language='pycon', execute=True, cwd=tmp_path, document=doc)
+
+
+def test_execute_default_language(tmp_path):
+    doc = RstDocument('default', verbose=False)
+    block = CodeBlock('echo hello', execute=True, cwd=tmp_path, document=doc)
+    assert doc.input_paths() == {tmp_path.resolve(): True}
+    CodeBlock(['print(1)'], language='pycon', execute=True, document=doc) # cwd not given, not an input
+    assert doc.input_paths() == {tmp_path.resolve(): True}
+    assert block.rst == '.. code-block:: \n\n    echo hello\n    hello\n    \n\n'
+    assert block.language == ''
+
+
+def test_save_load(tmp_path):
+    doc = RstDocument('saved', verbose=False, headings_numbered_from_level=2)
+    build_small(doc)
+    Paragraph(40*'word ', document=doc)
+    CodeBlock('echo run >> runs; cat runs', language='bash', execute=True, cwd=tmp_path, document=doc)
+    CodeBlock(['x = 6*7', 'print(x)'], language='pycon', execute=True, cwd=tmp_path, document=doc)
+    doc.render()
+    for filename in ('saved.json', 'saved.json.gz'):
+        doc.save(tmp_path / filename)
+
+        loaded = RstDocument.load(tmp_path / filename)
+        loaded.render()
+        assert loaded.rst == doc.rst
+
+        narrow = RstDocument.load(tmp_path / filename, width=40)
+        narrow.render()
+        word_lines = lambda rst: sum('word' in line for line in rst.splitlines())
+        assert word_lines(narrow.rst) > word_lines(doc.rst)
+        assert '>>> print(x)\n    42\n' in narrow.rst
+    assert (tmp_path / 'runs').read_text() == 'run\n'
+
+    for name in ('subprocess.Popen', 'et_rstor.RenderCache', 'et_rstor.no_such_class'):
+        with pytest.raises(ValueError):
+            RstItem.from_state({'class': name, 'args': 'ls'}, doc)
+
+    doc = RstDocument('callouts', verbose=False)
+    Callout('saved without slots', document=doc)
+    doc.render()
+    doc.save(tmp_path / 'callouts.json')
+    loaded = RstDocument.load(tmp_path / 'callouts.json')
+    loaded.render()
+    assert loaded.rst == doc.rst
+
+
+def test_progress_levels(tmp_path):
+    import io
+    for verbose, expected, unexpected in [ (SUMMARY, ['small.rst written'], ['rstor> Paragraph', '$$$$$$'])
+                                         , (False, [], ['rstor>', '$$$$$$'])
+                                         , (True, ['rstor> Paragraph', 'ms', 'small.rst unchanged'], ['$$$$$$'])
+                                         , (RST, ['rstor> Table', '$$$$$$\n.. code-block:: python'], [])
+                                         ]:
+        stream = io.StringIO()
+        start_progress_logging(stream)
+        doc = RstDocument('small', verbose=verbose)
+        build_small(doc)
+        doc.write(tmp_path)
+        stop_progress_logging()
+        for text in expected:
+            assert text in stream.getvalue()
+        for text in unexpected:
+            assert text not in stream.getvalue()
+    assert progress_logger().handlers
+    stop_progress_logging()
+
+
+def test_progress_bar(tmp_path):
+    import io
+    import json
+
+    class Terminal(io.StringIO):
+        def isatty(self):
+            return True
+
+    timings = tmp_path / 'timings'
+    terminal = Terminal()
+    doc = RstDocument('small', verbose=False, progress=ProgressBar(timings, stream=terminal))
+    build_small(doc)
+    doc.write(tmp_path)
+    assert '[  ?%] small: Heading A small document' in terminal.getvalue()
+    assert terminal.getvalue().endswith('[100%] small: 5 items\x1b[K\n')
+    durations = json.loads((timings / 'small.json').read_text())
+    assert len(durations) == 5
+
+    log = io.StringIO()
+    start_progress_logging(log)
+    doc = RstDocument('small', verbose=False, progress=ProgressBar(timings, stream=log))
+    build_small(doc)
+    doc.write(tmp_path)
+    stop_progress_logging()
+    lines = log.getvalue().splitlines()
+    assert len(lines) == 6
+    assert lines[0].startswith('[  0%] small: Heading A small document  ETA ')
+    assert lines[-1] == '[100%] small: 5 items'
+
+    doc = RstDocument('same', verbose=False, progress=ProgressBar(timings, stream=log))
+    for i in range(3):
+        Paragraph('Same text.', document=doc)
+    doc.write(tmp_path)
+    durations = json.loads((timings / 'same.json').read_text())
+    assert [key[-2:] for key in durations] == [':0', ':1', ':2']
+    assert sorted(p.name for p in timings.iterdir()) == ['same.json', 'small.json']
+
+
+def test_profiler(tmp_path):
+    import json
+    doc = RstDocument('profiled', verbose=False, profiler=Profiler())
+    build_small(doc)
+    CodeBlock( 'sleep 0.05', language='bash', execute=True, cwd=tmp_path
+             , setup=lambda: None, copyto=tmp_path / 'sleep.sh', document=doc
+             )
+    doc.write(tmp_path)
+
+    profile = json.loads(doc.profile_report(n=3, format='json'))
+    assert profile['n_items'] == 6
+    assert len(profile['items']) == 3
+    slowest = profile['items'][0]
+    assert slowest['item'] == 'CodeBlock'
+    assert slowest['location'] == f'{__file__}:{test_profiler.__code__.co_firstlineno + 4}'
+    assert set(slowest['phases']) == {'construct', 'render', 'setup', 'execute', 'command', 'copyto'}
+    assert slowest['phases']['execute'] >= 0.05
+    assert list(profile['phases'])[0] == 'build'
+    assert set(profile['documents']['profiled']) == {'write', 'build'}
+
+    report = doc.profile_report()
+    assert report.startswith('Profile of 6 items\n')
+    first_item = report.splitlines()[len(profile['phases']) + 4]
+    assert first_item.split()[1:3] == ['CodeBlock', 'profiled']
+
+
+def test_hooks(tmp_path):
+    events = []
+    doc = RstDocument('hooked', verbose=False)
+    doc.hooks.register('after_render', lambda item, elapsed: events.append(('render', item.__class__.__name__)))
+    doc.hooks.register('after_execute', lambda item, elapsed: events.append(('execute', item.lines[0])))
+
+    @doc.hooks.register('before_execute')
+    def fake_date(item):
+        if item.lines == ['date']:
+            return [('Mon Jan  1 00:00:00 UTC 2024\n', '')]
+
+    def upper(document):
+        document.rst = document.rst.upper()
+
+    hooks.register('before_write', upper)
+    try:
+        Paragraph('Today is:', document=doc)
+        CodeBlock('date', language='bash', execute=True, cwd=tmp_path, document=doc)
+        CodeBlock('echo hello', language='bash', execute=True, cwd=tmp_path, document=doc)
+        doc.write(tmp_path)
+    finally:
+        hooks.unregister('before_write', upper)
+    assert not hooks
+
+    assert events == [ ('render', 'Paragraph')
+                     , ('execute', 'date'), ('render', 'CodeBlock')
+                     , ('execute', 'echo hello'), ('render', 'CodeBlock')
+                     ]
+    rst = (tmp_path / 'hooked.rst').read_text()
+    assert 'MON JAN  1 00:00:00 UTC 2024' in rst
+    assert '    HELLO\n' in rst
+
+    doc = RstDocument('hooked', verbose=False)
+    doc.hooks.register('before_render', lambda item: 'cached\n\n' if isinstance(item, Paragraph) else None)
+    Paragraph('Not rendered.', document=doc)
+    Heading('Rendered', level=2, document=doc)
+    doc.render()
+    assert doc.rst.startswith('cached\n\nRendered\n')
+
+
+def test_generator():
+    from et_rstor.generator import generate
+    doc = generate(200, seed=7, verbose=False)
+    doc.render()
+    assert len(doc.items) == 200
+    assert {item.__class__.__name__ for item in doc.items} == {'Heading', 'Paragraph', 'Note', 'List', 'Table', 'CodeBlock'}
+    for markup in ('**', '``', '>`_', ':ref:`'):
+        assert markup in doc.rst
+
+    same = generate(200, seed=7, verbose=False)
+    same.render()
+    assert same.rst == doc.rst
+    other = generate(200, seed=8, verbose=False, mix={'Paragraph': 1})
+    assert {item.__class__.__name__ for item in other.items} == {'Paragraph'}
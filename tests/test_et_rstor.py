@@ -8,6 +8,7 @@ of micc2 which are inspected visually, not automatically.
 
 from pathlib import Path
 import re
+import shutil
 import sys
 if not '.' in sys.path:
     sys.path.insert(0, '.')
@@ -18,6 +19,7 @@ pydist, pyver, os_so = extension_suffix.split('-')
 os,soext = os_so.split('.')
 
 from et_rstor import *
+from et_rstor.build import declare
 
 
 def test_re():
@@ -47,6 +49,7 @@ def process(doc):
 workspace = Path.home() / 'software/dev/workspace/Tutorials'
 snippets = Path(__file__).parent / '../snippets'
 
+@declare(workspace=workspace)
 def test_TutorialGettingStarted():
 
     if workspace.exists():
@@ -964,6 +967,7 @@ def test_TutorialGettingStarted():
 project_name = 'ET-dot'
 project_path = workspace / project_name
 
+@declare(workspace=workspace)
 def test_TutorialProject_et_dot_1():
 
     if workspace.exists():
@@ -2096,6 +2100,7 @@ class FilterCMakeLists:
         return lines_kept
 
 
+@declare(depends_on='TutorialProject_et_dot_1', workspace=project_path)
 def test_TutorialProject_et_dot_2():
 
     doc = RstDocument('TutorialProject_et_dot_2', headings_numbered_from_level=2, is_default_document=True)
@@ -2303,6 +2308,7 @@ def test_TutorialProject_et_dot_2():
         print('<<<<<<')
 
 
+@declare(workspace=project_path)
 def test_TutorialProject_et_dot_3():
 
     doc = RstDocument('TutorialProject_et_dot_3', headings_numbered_from_level=2, is_default_document=True)
@@ -2357,6 +2363,7 @@ def test_TutorialProject_et_dot_3():
         "is simpler that for the Fortran case."
     )
 
+@declare(workspace=project_path)
 def test_TutorialProject_et_dot_4():
     doc = RstDocument('TutorialProject_et_dot_4', headings_numbered_from_level=2, is_default_document=True)
     doc.heading_numbers[2] = 3
@@ -2455,6 +2462,7 @@ def test_TutorialProject_et_dot_4():
 
     process(doc)
 
+@declare(workspace=project_path)
 def test_TutorialProject_et_dot_5():
     doc = RstDocument('TutorialProject_et_dot_5', headings_numbered_from_level=2, is_default_document=True)
     doc.heading_numbers[2] = 2
@@ -2503,6 +2511,7 @@ def test_TutorialProject_et_dot_5():
     """
     process(doc)
 
+@declare(workspace=project_path)
 def test_TutorialProject_et_dot_6():
     doc = RstDocument('TutorialProject_et_dot_6', headings_numbered_from_level=2, is_default_document=True)
     doc.heading_numbers[2] = 2
@@ -2531,6 +2540,7 @@ def test_TutorialProject_et_dot_6():
     process(doc)
 
 
+@declare(workspace=project_path)
 def test_TutorialProject_et_dot_7():
     doc = RstDocument('TutorialProject_et_dot_7', headings_numbered_from_level=2, is_default_document=True)
     doc.heading_numbers[2] = 2
@@ -2630,6 +2640,7 @@ def test_TutorialProject_et_dot_7():
 
     process(doc)
 
+@declare(workspace=project_path)
 def test_TutorialProject_et_dot_8():
     doc = RstDocument('TutorialProject_et_dot_8', headings_numbered_from_level=2, is_default_document=True)
     doc.heading_numbers[2] = 3
@@ -2930,6 +2941,7 @@ def test_TutorialVCS():
     process(doc)
 
 
+@declare(depends_on='TutorialProject_et_dot_1', workspace=workspace/'foo')
 def test_TutorialVersionManagement():
 
     wsfoo = workspace/'foo'
@@ -3006,6 +3018,7 @@ def test_TutorialVersionManagement():
     process(doc)
 
 
+@declare(depends_on='TutorialProject_et_dot_1', workspace=workspace/'foo')
 def test_TutorialPublish():
 
     wsfoo = workspace / 'foo'
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""Import time benchmark: ``import et_rstor`` must stay cheap, as small document generating
+scripts may be run thousands of times.
+
+The budget (in ms) can be overridden with the environment variable ET_RSTOR_IMPORT_BUDGET_MS.
+"""
+
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+budget_ms = float(os.environ.get('ET_RSTOR_IMPORT_BUDGET_MS', 35))
+project_dir = Path(__file__).parent.parent
+
+lazy_modules = ['subprocess', 'shutil', 'traceback', 'io', 'hashlib', 'sqlite3', 'logging']
+
+
+def run_python(code, importtime=False):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None) # measure the import, not the compilation
+    args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    return subprocess.run(args, cwd=project_dir, env=env, capture_output=True, text=True, check=True)
+
+
+def import_time_us():
+    """Cumulative import time of et_rstor in a fresh interpreter, in microseconds."""
+    stderr = run_python('import et_rstor', importtime=True).stderr
+    for line in stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'et_rstor':
+            return int(fields[1])
+    raise RuntimeError(f'et_rstor not found in import times:\n{stderr}')
+
+
+def test_lazy_imports():
+    code = f"import sys, et_rstor; print([m for m in {lazy_modules} if m in sys.modules])"
+    # some modules may be imported by the interpreter itself, e.g. io
+    baseline = eval(run_python(code.replace('et_rstor', 'pathlib')).stdout)
+    imported = eval(run_python(code).stdout)
+    assert imported == baseline
+
+
+def test_import_time():
+    import_time_us() # warm up, writes the bytecode
+    best = min(import_time_us() for _ in range(5))
+    print(f'import et_rstor: {best/1000:.1f} ms (budget {budget_ms} ms)')
+    assert best < 1000*budget_ms
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Memory benchmark: bytes per RstItem in a large document, measured with tracemalloc.
+
+Run ``python tests/test_memory.py [n]`` for a report.
+"""
+
+import sys
+if not '.' in sys.path:
+    sys.path.insert(0, '.')
+import tracemalloc
+
+import pytest
+
+from et_rstor import *
+from et_rstor.generator import Generator, default_mix
+
+
+def bytes_per_item(kind, n, **kwargs):
+    """Net memory allocated per item for a document of n generated items of kind."""
+    generator = Generator(seed=0)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        doc = RstDocument('memory', verbose=False, **kwargs)
+        doc.set_textwrapper(TextWrapper(doc.width, cache=False)) # measure the items only
+        for i in range(n):
+            generator.item(kind, doc)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / n
+
+
+def report(n=10000):
+    lines = [f"{'item':<10} {'bytes/item':>12} {'drop_sources':>14}"]
+    for kind in default_mix:
+        lines.append( f'{kind:<10} {bytes_per_item(kind, n):12.0f}'
+                      f' {bytes_per_item(kind, n, drop_sources=True):14.0f}'
+                    )
+    return '\n'.join(lines)
+
+
+def test_slots():
+    doc = RstDocument('memory', verbose=False)
+    generator = Generator(seed=0)
+    for kind in default_mix:
+        assert not hasattr(generator.item(kind, doc), '__dict__')
+
+
+def test_drop_sources():
+    for kind in default_mix:
+        assert bytes_per_item(kind, 100, drop_sources=True) < bytes_per_item(kind, 100), kind
+
+    doc = RstDocument('dropped', verbose=False, drop_sources=True)
+    block = CodeBlock( ['print(42)'], language='pycon', execute=True, setup=lambda: None
+                     , filter=lambda lines: lines, document=doc
+                     )
+    assert '42' in block.rst
+    assert all(getattr(block, field) is None for field in ('lines', 'outputs', 'setup', 'filter', 'copyto'))
+
+
+@pytest.mark.parametrize('reset_peak', [True, False])
+def test_memory_profiler(tmp_path, monkeypatch, reset_peak):
+    if not reset_peak: # as before Python 3.9
+        monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    profiler = MemoryProfiler()
+    try:
+        doc = RstDocument('memory', verbose=False, profiler=profiler)
+        generator = Generator(seed=0)
+        for i in range(20):
+            generator.paragraph(doc)
+        kept = []
+        CodeBlock(['true'], execute=True, setup=lambda: bytearray(10**7), cwd=tmp_path, document=doc)
+        CodeBlock(['true'], execute=True, setup=lambda: kept.append(bytearray(10**6)), cwd=tmp_path, document=doc)
+        profile = profiler.as_dict(n=3)
+        report = profiler.report(n=3)
+    finally:
+        profiler.stop()
+
+    big, kept = profile['memory'][:2]
+    assert big['item'] == kept['item'] == 'CodeBlock'
+    assert big['memory']['render']['peak'] >= 10**7
+    assert big['memory']['render']['net'] < 10**6
+    assert 10**6 <= kept['memory']['render']['net'] < 2*10**6
+    assert kept['memory']['construct']['net'] < 10**5
+    assert profile['lines'][0][1] >= 10**6
+    assert f'{big["peak"]:12d}' in report
+
+
+if __name__ == "__main__":
+    print(report(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
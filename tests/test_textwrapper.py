@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for TextWrapper."""
+
+import sys
+if not '.' in sys.path:
+    sys.path.insert(0, '.')
+import random
+import re
+
+from et_rstor import *
+from et_rstor.generator import Generator
+
+# A model of TextWrapper.split: the word by word joining loop of et_rstor 1.2.0 (which only
+# looked for the closing word of a span in the next lookahead (15) words), with the rules of the
+# current TextWrapper.patterns rewritten per word. It checks the single scan of TextWrapper.spans
+# against a direct implementation of the same rules, not against the output of et_rstor 1.2.0.
+punctuation = r"([,.:;!?\"\')}]?|(\.\.\.))\Z"
+reference_patterns = \
+( ( r"\A\*\w[^*]*\Z"         , r"\A\w+\*" + punctuation )
+, ( r"\A\*\*\w[^*]*\Z"       , r"\A\w+\*\*" + punctuation )
+, ( r"\A``[^`]+\Z"           , r"\A[^`]*[^\\`]``" + punctuation )
+, ( r"\A`[^`]+\Z"            , r"\A[^`]+`(__?)?" + punctuation )
+, ( r"\A:[\w.:+-]+:`[^`]*\Z" , r"\A[^`]+`(__?)?" + punctuation )
+, ( r"\A\|[^|]+\Z"           , r"\A[^|]+\|(__?)?" + punctuation )
+)
+
+def reference_split(text, lookahead=10**9):
+    patterns = [(re.compile(p0), re.compile(p1)) for p0, p1 in reference_patterns]
+    words = text.split(' ')
+    n = len(words)
+    i = 0
+    while i < n:
+        for p0, p1 in patterns:
+            if p0.match(words[i]):
+                for j in range(1, lookahead + 1):
+                    if i + j >= n:
+                        break
+                    if p1.match(words[i+j]):
+                        words[i] = ' '.join(words[i:i+j+1])
+                        del words[i+1:i+j+1]
+                        n -= j
+                        break
+                break
+        i += 1
+    return words
+
+
+def test_split_as_reference():
+    wrapper = TextWrapper()
+    texts = [ ''
+            , ' '
+            , 'a  b '
+            , 'one **two three** four'
+            , '**bold** and **never closed, and *italic* and *also unclosed'
+            , '``code`` ``with spaces``... `link text <https://example.com/a?b=c>`_, done'
+            , '`link text <not a url>`_ *a* **b**. ``c``) *x y*z* **p**q q**'
+            , '**' + ' '.join(20*['long']) + '** **' + ' '.join(10*['short']) + '**!'
+            , 'stray * and ** asterisks *here, there* and ** every**where**'
+            , 'see :ref:`version control <vcm>` and :file:`path with spaces`, or :py:meth:`Foo.bar` x y`'
+            , '|sub name| and |sub| [#]_ [1]_ Name_ `a phrase`_ `anonymous phrase`__. `interpreted text` | a |b'
+            ]
+    rng = random.Random(0)
+    for seed in range(20):
+        text = Generator(seed, span_words=(1, 20)).text(200)
+        texts.append(text)
+        words = text.split(' ')
+        for _ in range(10): # sprinkle double spaces and stray delimiters
+            words.insert(rng.randrange(len(words)), rng.choice(['', '*', '**', '``', '`', '*a', 'b**', ':file:`x', 'y`', '|', '|s', 't|']))
+        texts.append(' '.join(words))
+    for text in texts:
+        assert wrapper.split(text) == reference_split(text), text
+
+
+def test_long_spans():
+    wrapper = TextWrapper()
+    long = '**' + ' '.join(40*['bold']) + '**'
+    assert wrapper.split(f'a {long}, b') == ['a', long + ',', 'b']
+    assert wrapper.split(f'*unclosed {long} and *x y*') == [f'*unclosed {long} and *x y*']
+    assert wrapper.split(f'*unclosed {long} x') == ['*unclosed', long, 'x']
+    assert wrapper.split('*a **b c** d*') == ['*a **b c** d*']
+    assert wrapper.split('**b*c ``d e`` **') == ['**b*c', '``d e``', '**']
+    text = 1000*'**unclosed 2 * 3 ' + '*a b*'
+    assert wrapper.split(text) == text.split(' ')[:-2] + ['*a b*']
+
+
+def test_roles():
+    wrapper = TextWrapper(width=30)
+    text = 'Read :ref:`version control management <vcm>` and open :file:`a path with spaces`. ' \
+           'Then see |project name|, the footnote [#]_ and `the docs`_ or Name_.'
+    lines = wrapper.wrap(text)
+    assert ' '.join(lines) == text
+    for span in (':ref:`version control management <vcm>`', ':file:`a path with spaces`.', '|project name|,', '`the docs`_'):
+        assert any(span in line for line in lines), span
+    assert wrapper.split(':py:meth:`Foo.bar` is self-contained, unlike this`') \
+        == [':py:meth:`Foo.bar`', 'is', 'self-contained,', 'unlike', 'this`']
+
+
+def test_wrap():
+    wrapper = TextWrapper(width=60)
+    text = "The *MIT license* is a **very liberal** license and the ``default option``. If you’re unsure which " \
+           "license to choose, you can use resources such as `GitHub’s Choose a License <https://choosealicense.com>`_!"
+    lines = wrapper.wrap(text)
+    assert ' '.join(lines) == text
+    assert '`GitHub’s Choose a License <https://choosealicense.com>`_!' in lines
+    assert all(line.count('**') % 2 == 0 and line.count('``') % 2 == 0 for line in lines)
+
+
+def tutorial_paragraphs():
+    """The texts of the Paragraphs, Notes and Lists of the tutorials in test_et_rstor.py."""
+    import ast
+    from pathlib import Path
+    tree = ast.parse((Path(__file__).parent / 'test_et_rstor.py').read_text(encoding='utf-8'))
+    texts = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'id', None) in ('Paragraph', 'Note', 'List') and node.args:
+            try:
+                text = ast.literal_eval(node.args[0])
+            except ValueError:
+                continue
+            texts.extend([text] if isinstance(text, str) else [t for t in text if isinstance(t, str)])
+    return texts
+
+
+def test_wrap_tutorial():
+    texts = tutorial_paragraphs()
+    assert any('``git commit -m <message>``,' in text for text in texts)
+    for width in (20, 40, 72):
+        wrapper = TextWrapper(width=width, cache=False)
+        for text in texts:
+            lines = wrapper.wrap(text)
+            words = wrapper.split(text)
+            for line in lines:
+                assert len(line) <= width or line in words, line # only a single span is longer
+            for literal in re.findall(r"(?<![^ ])``[^ `](?:[^`]*?[^ \\`])?``", text):
+                assert any(literal in line for line in lines), literal
+
+
+def test_digest():
+    class Wrapper(TextWrapper):
+        patterns = TextWrapper.patterns[:3]
+
+    assert TextWrapper.digest() == TextWrapper(width=40).digest()
+    assert Wrapper.digest() != TextWrapper.digest()
+    doc = RstDocument('digest', verbose=False)
+    paragraph = Paragraph('Some text.', document=doc)
+    fingerprint = paragraph.fingerprint()
+    doc.set_textwrapper(Wrapper(width=doc.width))
+    assert paragraph.fingerprint() != fingerprint
+
+
+def test_wrap_cache():
+    cache = WrapCache(max_size=100)
+    wrapper = TextWrapper(width=20, cache=cache)
+    text = 'Some **boiler plate** text that is wrapped.'
+    lines = wrapper.wrap(text)
+    assert isinstance(lines, tuple)
+    assert wrapper.wrap(text) is lines
+    assert TextWrapper(width=20, cache=cache).wrap(text) is lines # shared
+    assert TextWrapper(width=30, cache=cache).wrap(text) != lines
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert cache.hit_rate() == 0.5
+
+    for i in range(3):
+        wrapper.wrap(f'{i}' + 40*'x')
+    assert cache.size <= 100
+    assert len(cache.entries) == 2
+    assert (TextWrapper, TextWrapper.digest(), 20, text) not in cache.entries
+
+    class Upper(TextWrapper): # same patterns, other wrapping
+        def _wrap(self, text):
+            return tuple(line.upper() for line in super()._wrap(text))
+    shared = WrapCache()
+    assert TextWrapper(width=20, cache=shared).wrap(text) != Upper(width=20, cache=shared).wrap(text)
+
+    assert TextWrapper(cache=False).cache is None
+    assert TextWrapper().cache is wrap_cache